@@ -0,0 +1,86 @@
+from collections import defaultdict
+
+from django.db.models import Count, Sum
+
+from .batches import LOOKUP_BATCH_SIZE, WRITE_BATCH_SIZE
+from .models import Address, AddressTransaction
+from .outpoints import is_coinbase_outpoint
+
+
+# Updates the address index with a batch of block records (see ingest.block_to_record), once their rows
+# are saved. tx_rows are the saved Transaction rows, in the same order as the txs of the records, and
+# prev_outputs has the (address, amount) of the outputs spent by the batch, by outpoint.
+def index_addresses(records, tx_rows, prev_outputs):
+    txs = [(record['block']['height'], tx) for record in records for tx in record['txs']]
+    # What each tx did to each address: (address, tx row, height, received, sent).
+    changes = []
+    for tx_row, (height, tx) in zip(tx_rows, txs):
+        amounts = defaultdict(lambda: [0, 0])
+        for tx_out in tx['outputs']:
+            if tx_out['address'] is not None:
+                amounts[tx_out['address']][0] += tx_out['amount']
+        for tx_in in tx['inputs']:
+            outpoint = (tx_in['prev_tx'], tx_in['prev_index'])
+            if is_coinbase_outpoint(outpoint):
+                continue
+            prev_output = prev_outputs.get(outpoint)
+            # Outputs that couldn't be found were already reported by the writer.
+            if prev_output is None:
+                continue
+            address, amount = prev_output
+            if address is not None:
+                amounts[address][1] += amount
+        for address, (received, sent) in amounts.items():
+            changes.append((address, tx_row, height, received, sent))
+    # We load the addresses that already exist and create the rest.
+    unique_addresses = list(set(change[0] for change in changes))
+    address_rows = {}
+    for i in range(0, len(unique_addresses), LOOKUP_BATCH_SIZE):
+        for address_row in Address.objects.filter(address__in=unique_addresses[i:i + LOOKUP_BATCH_SIZE]):
+            address_rows[address_row.address] = address_row
+    existing = list(address_rows.values())
+    new = []
+    history = []
+    for address, tx_row, height, received, sent in changes:
+        address_row = address_rows.get(address)
+        if address_row is None:
+            address_row = Address(address=address)
+            address_rows[address] = address_row
+            new.append(address_row)
+        address_row.balance += received - sent
+        address_row.received += received
+        address_row.sent += sent
+        address_row.tx_count += 1
+        history.append((address_row, tx_row, height, received, sent))
+    Address.objects.bulk_update(existing, ['balance', 'received', 'sent', 'tx_count'], batch_size=WRITE_BATCH_SIZE)
+    # bulk_create sets the primary keys of the new addresses, which the history rows need.
+    Address.objects.bulk_create(new, batch_size=WRITE_BATCH_SIZE)
+    AddressTransaction.objects.bulk_create([
+        AddressTransaction(address=address_row, transaction=tx_row, height=height, received=received, sent=sent)
+        for address_row, tx_row, height, received, sent in history
+    ], batch_size=WRITE_BATCH_SIZE)
+
+
+# Undoes what the blocks above the given height did to the address index. Called from ingest.rollback,
+# before the txs are deleted. The addresses are loaded and saved back in batches, like index_addresses does.
+def rollback_addresses(height):
+    rows = AddressTransaction.objects.filter(transaction__block__height__gt=height)
+    totals = {total['address']: total for total in rows.values('address').annotate(
+        total_received=Sum('received'), total_sent=Sum('sent'), txs=Count('pk_id'))}
+    pk_ids = list(totals)
+    address_rows = []
+    for i in range(0, len(pk_ids), LOOKUP_BATCH_SIZE):
+        address_rows.extend(Address.objects.filter(pk_id__in=pk_ids[i:i + LOOKUP_BATCH_SIZE]))
+    for address_row in address_rows:
+        total = totals[address_row.pk_id]
+        address_row.balance -= total['total_received'] - total['total_sent']
+        address_row.received -= total['total_received']
+        address_row.sent -= total['total_sent']
+        address_row.tx_count -= total['txs']
+    # Addresses that only appeared in the deleted blocks are deleted too.
+    empty = [address_row.pk_id for address_row in address_rows if address_row.tx_count == 0]
+    Address.objects.bulk_update([address_row for address_row in address_rows if address_row.tx_count > 0],
+                                ['balance', 'received', 'sent', 'tx_count'], batch_size=WRITE_BATCH_SIZE)
+    rows.delete()
+    for i in range(0, len(empty), LOOKUP_BATCH_SIZE):
+        Address.objects.filter(pk_id__in=empty[i:i + LOOKUP_BATCH_SIZE]).delete()
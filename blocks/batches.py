@@ -0,0 +1,6 @@
+# Sizes of the batches the rows are read and written in, shared by the writer and the indexes it updates.
+
+# Max. number of values in a single IN (...) lookup.
+LOOKUP_BATCH_SIZE = 1000
+# Max. number of rows sent in a single INSERT or UPDATE, keeps us below the db's limit of query parameters.
+WRITE_BATCH_SIZE = 5000
@@ -0,0 +1,104 @@
+import hashlib
+import json
+from itertools import chain
+
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from rest_framework.response import Response
+
+from .models import BlockRow, Transaction, TxInput
+
+# Blocks with this many confirmations are not expected to be reorganized, so their responses are cached
+# (by us and by clients) for FINAL_TIMEOUT. Responses for the blocks above them are cached for RECENT_TIMEOUT.
+FINAL_CONFIRMATIONS = 6
+FINAL_TIMEOUT = 30 * 24 * 3600
+RECENT_TIMEOUT = 30
+# A tx never changes, but its outputs get spent. The writer drops the txs it spends from the cache, which
+# only reaches the web processes if the cache is shared (see CACHES in the settings), so they're cached for
+# TX_TIMEOUT at most, and clients revalidate them after RECENT_TIMEOUT.
+TX_TIMEOUT = 300
+# How long the height of the tip is cached.
+TIP_TIMEOUT = 10
+TIP_KEY = 'tip_height'
+
+
+def block_key(height):
+    return 'block:{}'.format(height)
+
+
+def tx_key(tx_id):
+    return 'tx:{}'.format(tx_id)
+
+
+def tip_height():
+    height = cache.get(TIP_KEY)
+    if height is None:
+        height = BlockRow.objects.aggregate(Max('height'))['height__max'] or 0
+        cache.set(TIP_KEY, height, TIP_TIMEOUT)
+    return height
+
+
+def forget_tip():
+    cache.delete(TIP_KEY)
+
+
+# Returns whether a block at the given height is deep enough to be final.
+def is_final(height):
+    return tip_height() - height + 1 >= FINAL_CONFIRMATIONS
+
+
+# ETag of the data of a response.
+def make_etag(data):
+    return quote_etag(hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest())
+
+
+# Returns the response with the given key from the cache, answering 304 when the client already has it.
+# If it's not cached, load() returns (data, timeout, max_age): the data is cached for timeout seconds and
+# clients are told to keep it for max_age seconds.
+def cached_response(request, key, load):
+    entry = cache.get(key)
+    if entry is None:
+        data, timeout, max_age = load()
+        entry = (data, make_etag(data), max_age)
+        cache.set(key, entry, timeout)
+    data, etag, max_age = entry
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+    response = Response(data)
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=max_age)
+    return response
+
+
+# Drops the cached txs with the given hashes, e.g. because some of their outputs were just spent.
+def forget_transactions(tx_hashes):
+    cache.delete_many([tx_key(bytes(tx_hash).hex()) for tx_hash in tx_hashes])
+
+
+# Drops every response we cached. django-redis deletes just the keys with our KEY_PREFIX (see CACHES in
+# the settings), so other apps sharing the Redis server keep theirs. The local memory cache is private to
+# the process, so it only has our keys.
+def forget_everything():
+    if hasattr(cache, 'delete_pattern'):
+        cache.delete_pattern('*')
+    else:
+        cache.clear()
+
+
+# Drops what is cached about the blocks above the given height, which are about to be rolled back: the
+# blocks, their txs and the txs they spent. Called from ingest.rollback.
+def forget_blocks_above(height):
+    top = BlockRow.objects.aggregate(Max('height'))['height__max']
+    if top is None or top <= height:
+        return
+    if height == 0:
+        forget_everything()
+        return
+    cache.delete_many([block_key(h) for h in range(height + 1, top + 1)])
+    forget_tip()
+    tx_hashes = Transaction.objects.filter(block__height__gt=height).values_list('hash_id', flat=True)
+    prev_txs = TxInput.objects.filter(transaction__block__height__gt=height).values_list('prev_tx', flat=True)
+    forget_transactions(set(bytes(tx_hash) for tx_hash in chain(tx_hashes, prev_txs)))
@@ -0,0 +1,312 @@
+from django.db import connection, transaction
+
+from library.blockparser import read_varint_at
+from library.chain import ChainTip
+from library.helper import encode_varint, h160_to_p2pkh_address, hash160, int_to_little_endian
+from helper_functions import get_type
+from .addresses import index_addresses, rollback_addresses
+from .batches import LOOKUP_BATCH_SIZE, WRITE_BATCH_SIZE
+from .caching import forget_blocks_above, forget_everything, forget_tip, forget_transactions
+from .models import (
+    Address, AddressTransaction, BlockRow, BlockStats, DailyStats, Transaction, TxInput, TxOutput)
+from .outpoints import OutpointMap, is_coinbase_outpoint, load_outputs
+from .stats import index_stats, rollback_stats
+
+# Type of the outputs that don't follow any of the standard scripts (see helper_functions.get_type).
+NONSTANDARD = 'NONSTANDARD'
+
+
+# Serializes the witness of a tx input the way it's stored in the db: the number of items followed by
+# each item with its length, as in the segwit serialization of the tx.
+# Returns None if the input has no witness.
+def serialize_witness(tx_in):
+    if not hasattr(tx_in, 'witness'):
+        return None
+    witness = encode_varint(len(tx_in.witness))
+    for item in tx_in.witness:
+        # Empty items are parsed as 0.
+        if type(item) == int:
+            witness += int_to_little_endian(item, 1)
+        else:
+            witness += encode_varint(len(item)) + item
+    return witness
+
+
+# Removes the length in front of a serialized script, leaving the raw script we store.
+def raw_script(serialized_script):
+    _, offset = read_varint_at(serialized_script, 0)
+    return serialized_script[offset:]
+
+
+# Returns the type, address and OP_RETURN data of an output. P2PK outputs are indexed under the P2PKH
+# address of their public key, as other explorers do. Non-standard outputs (bare multisig, scripts that
+# can't even be parsed...) have no address, but are saved all the same with their ScriptPubKey.
+def describe_output(tx_out):
+    try:
+        out_type = get_type(tx_out)
+    except SyntaxError:
+        out_type = None
+    if out_type is None:
+        return NONSTANDARD, None, None
+    # If output is OP_RETURN, address doesn't apply.
+    # Also, we need to find the return data.
+    if out_type == 'OP_RETURN':
+        return out_type, None, tx_out.script_pubkey.get_op_return_data()
+    if out_type == 'P2PK':
+        return out_type, h160_to_p2pkh_address(hash160(tx_out.script_pubkey.cmds[0])), None
+    return out_type, tx_out.script_pubkey.address(), None
+
+
+# Turns a parsed BlockMessage, at the given height, into plain python records (dicts and lists) with the
+# values of every row we need to save for that block. Records don't touch the db, so they can be built anywhere.
+def block_to_record(block_message, height):
+    block = {
+        'hash_id': block_message.hash(),
+        'height': height,
+        'version': block_message.version,
+        'prev_block': block_message.prev_block,
+        'merkle_root': block_message.merkle_root,
+        'timestamp': block_message.timestamp,
+        'bits': block_message.bits[::-1].hex(),
+        'nonce': block_message.nonce[::-1].hex(),
+        'txn_count': block_message.txn_count,
+    }
+    txs = []
+    for txn in block_message.txns:
+        inputs = []
+        for tx_in in txn.tx_inputs:
+            inputs.append({
+                'prev_tx': tx_in.prev_tx,
+                'prev_index': tx_in.prev_index,
+                # We don't need to parse the ScriptSig to get its bytes.
+                'script_sig': raw_script(tx_in.serialize_script_sig()),
+                'sequence': tx_in.sequence,
+                'witness': serialize_witness(tx_in),
+            })
+        outputs = []
+        for index, tx_out in enumerate(txn.tx_outputs):
+            out_type, address, op_return_data = describe_output(tx_out)
+            outputs.append({
+                'index': index,
+                'output_type': out_type,
+                'amount': tx_out.amount,
+                'address': address,
+                'script_pubkey': raw_script(tx_out.serialize_script_pubkey()),
+                'op_return_data': op_return_data,
+            })
+        txs.append({
+            'tx': {
+                'hash_id': txn.hash(),
+                'version': txn.version,
+                'locktime': txn.locktime,
+                'segwit': txn.segwit,
+            },
+            'inputs': inputs,
+            'outputs': outputs,
+        })
+    return {'block': block, 'txs': txs}
+
+
+# Applies a block record to a UTXO set (see library.utxo.UtxoSet).
+def connect_utxos(utxos, record):
+    created = []
+    spent = []
+    for tx in record['txs']:
+        for tx_out in tx['outputs']:
+            created.append((tx['tx']['hash_id'], tx_out['index'], tx_out['amount'], tx_out['script_pubkey']))
+        for tx_in in tx['inputs']:
+            outpoint = (tx_in['prev_tx'], tx_in['prev_index'])
+            if not is_coinbase_outpoint(outpoint):
+                spent.append(outpoint)
+    utxos.connect(record['block']['height'], record['block']['hash_id'], created, spent)
+
+
+# Builds the in-memory chain tip from the last saved block, with a single query over the height index.
+def load_tip():
+    last_block = BlockRow.objects.order_by('-height').values_list('height', 'hash_id').first()
+    # If there are no objects in the db, we start from the genesis block.
+    if last_block is None:
+        return ChainTip()
+    height, hash_id = last_block
+    return ChainTip(bytes(hash_id), height)
+
+
+# Finds the last saved block that is still part of the header chain, going back from our last saved
+# block over the height index. Returns its height, or None if no saved block is in the chain.
+def find_fork(chain, page_size=100):
+    rows = BlockRow.objects.order_by('-height').values_list('height', 'hash_id')
+    # Each page starts below the last one, so it's read from the height index rather than skipped over.
+    page = list(rows[:page_size])
+    while len(page) > 0:
+        for height, hash_id in page:
+            if chain.height_of(bytes(hash_id)) == height:
+                return height
+        page = list(rows.filter(height__lt=page[-1][0])[:page_size])
+    return None
+
+
+# Deletes every block saved above the given height, with its txs, inputs and outputs, and undoes its
+# changes to the address index. The outputs its inputs spent become unspent again.
+# Rows are deleted table by table, from the inputs and outputs up, so each delete is a single query
+# that goes through the foreign key indexes instead of loading the rows.
+def rollback(height):
+    forget_blocks_above(height)
+    with transaction.atomic():
+        rollback_addresses(height)
+        rollback_stats(height)
+        # The outputs spent by the deleted inputs are unspent again. They're found by outpoint, through the
+        # index on the tx hash, as the index on spent_by is only there once the initial sync is done.
+        outpoints = TxInput.objects.filter(transaction__block__height__gt=height).values_list('prev_tx', 'prev_index')
+        spent = load_outputs([(bytes(prev_tx), prev_index) for prev_tx, prev_index in outpoints
+                              if not is_coinbase_outpoint((bytes(prev_tx), prev_index))])
+        pk_ids = [pk_id for pk_id, _, _ in spent.values()]
+        for i in range(0, len(pk_ids), LOOKUP_BATCH_SIZE):
+            TxOutput.objects.filter(pk_id__in=pk_ids[i:i + LOOKUP_BATCH_SIZE]).update(spent_by=None)
+        TxInput.objects.filter(transaction__block__height__gt=height).delete()
+        TxOutput.objects.filter(transaction__block__height__gt=height).delete()
+        # Their inputs, outputs and address rows are gone, so nothing cascades: without _raw_delete, the
+        # collector would still load every tx and block to look for their related rows.
+        transactions = Transaction.objects.filter(block__height__gt=height)
+        transactions._raw_delete(transactions.db)
+        blocks = BlockRow.objects.filter(height__gt=height)
+        blocks._raw_delete(blocks.db)
+
+
+# Deletes every saved block and everything built from them (addresses and stats), like rollback(0), but
+# without going through the rows: on a full chain, rollback(0) would have to load and update every address
+# and output. On Postgres the tables are truncated, and their ids start over from 1.
+def delete_everything():
+    # Tables that point to others come first.
+    tables = [model._meta.db_table for model in [
+        AddressTransaction, Address, BlockStats, DailyStats, TxOutput, TxInput, Transaction, BlockRow]]
+    quoted = [connection.ops.quote_name(table) for table in tables]
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('TRUNCATE {} RESTART IDENTITY CASCADE'.format(', '.join(quoted)))
+        else:
+            for table in quoted:
+                cursor.execute('DELETE FROM {}'.format(table))
+            if connection.vendor == 'sqlite':
+                placeholders = ', '.join(['%s'] * len(tables))
+                cursor.execute('DELETE FROM sqlite_sequence WHERE name IN ({})'.format(placeholders), tables)
+    forget_everything()
+
+
+# Called when our last saved block is no longer in the header chain, because the network switched to a
+# branch with more work. Deletes the blocks of the old branch and returns the new tip.
+def reorganize(chain, tip):
+    height = find_fork(chain)
+    if height is None:
+        # None of our blocks is in the chain, so everything is deleted and we start from the genesis block.
+        rollback(0)
+        return ChainTip()
+    print('reorg: rolling back from {} to height {}'.format(tip, height))
+    rollback(height)
+    return ChainTip(chain.hash_at(height), height)
+
+
+# Buffers the rows of a batch of blocks in memory and writes them with one bulk insert per table,
+# inside a single db transaction, instead of one save() per row.
+class BlockWriter:
+
+    def __init__(self, batch_size=50, max_pending_txs=20000, max_outpoints=1000000, utxos=None, block_store=None):
+        # Max. number of blocks to keep in memory before writing them.
+        self.batch_size = batch_size
+        # Big blocks have thousands of txs, so we also flush when too many txs are waiting.
+        self.max_pending_txs = max_pending_txs
+        self.records = []
+        self.pending_txs = 0
+        # Unspent outputs of the batches already written, to link them to the inputs that spend them.
+        self.outpoints = OutpointMap(max_outpoints)
+        # UTXO set updated with the same blocks, if any (see library.utxo.UtxoSet).
+        self.utxos = utxos
+        # Store where the raw blocks are kept, if any (see library.blockstore.BlockStore).
+        self.block_store = block_store
+
+    # Sets spent_by on the outputs spent by the given inputs, which are already saved. Outputs created by the
+    # same batch (output_rows, not saved yet) are linked before they're saved, and the rest are found in
+    # the outpoint map and updated. Returns the (address, amount) of every spent output, by outpoint.
+    def link_spent_outputs(self, input_rows, output_rows):
+        created = {(output_row.transaction.hash_id, output_row.index): output_row for output_row in output_rows}
+        prev_outputs = {}
+        # Inputs that spend outputs of previous batches, by outpoint.
+        saved_spends = {}
+        for input_row in input_rows:
+            outpoint = (input_row.prev_tx, input_row.prev_index)
+            if is_coinbase_outpoint(outpoint):
+                continue
+            output_row = created.get(outpoint)
+            if output_row is None:
+                saved_spends[outpoint] = input_row
+            else:
+                output_row.spent_by = input_row
+                prev_outputs[outpoint] = (output_row.address, output_row.amount)
+        spent_rows = []
+        for outpoint, (pk_id, address, amount) in self.outpoints.spend(saved_spends).items():
+            spent_rows.append(TxOutput(pk_id=pk_id, spent_by=saved_spends[outpoint]))
+            prev_outputs[outpoint] = (address, amount)
+        TxOutput.objects.bulk_update(spent_rows, ['spent_by'], batch_size=WRITE_BATCH_SIZE)
+        if len(spent_rows) < len(saved_spends):
+            print('{} spent outputs not found'.format(len(saved_spends) - len(spent_rows)))
+        return prev_outputs
+
+    # Adds a parsed BlockMessage, at the given height, to the batch.
+    def add(self, block_message, height):
+        if self.block_store is not None:
+            raw_block = block_message.raw if block_message.raw is not None else block_message.serialize()
+            self.block_store.add(height, block_message.hash(), raw_block)
+        self.add_record(block_to_record(block_message, height))
+
+    # Adds an already built record (see block_to_record) to the batch.
+    def add_record(self, record):
+        self.records.append(record)
+        self.pending_txs += len(record['txs'])
+        if len(self.records) >= self.batch_size or self.pending_txs >= self.max_pending_txs:
+            self.flush()
+
+    # Writes every pending block to the db.
+    def flush(self):
+        if len(self.records) == 0:
+            return
+        with transaction.atomic():
+            # bulk_create sets the primary keys of the created rows (Postgres returns them), so the
+            # foreign keys of the next table can point to them directly.
+            block_rows = BlockRow.objects.bulk_create(
+                [BlockRow(**record['block']) for record in self.records], batch_size=WRITE_BATCH_SIZE)
+            tx_rows = []
+            for block_row, record in zip(block_rows, self.records):
+                for tx in record['txs']:
+                    tx_rows.append(Transaction(block=block_row, **tx['tx']))
+            Transaction.objects.bulk_create(tx_rows, batch_size=WRITE_BATCH_SIZE)
+            input_rows = []
+            output_rows = []
+            tx_records = (tx for record in self.records for tx in record['txs'])
+            for tx_row, tx in zip(tx_rows, tx_records):
+                for tx_in in tx['inputs']:
+                    input_rows.append(TxInput(transaction=tx_row, **tx_in))
+                for tx_out in tx['outputs']:
+                    output_rows.append(TxOutput(transaction=tx_row, **tx_out))
+            TxInput.objects.bulk_create(input_rows, batch_size=WRITE_BATCH_SIZE)
+            prev_outputs = self.link_spent_outputs(input_rows, output_rows)
+            TxOutput.objects.bulk_create(output_rows, batch_size=WRITE_BATCH_SIZE)
+            # The outputs that are still unspent can be spent by the next batches.
+            for output_row in output_rows:
+                if output_row.spent_by is None:
+                    outpoint = (output_row.transaction.hash_id, output_row.index)
+                    self.outpoints.add(outpoint, (output_row.pk_id, output_row.address, output_row.amount))
+            index_addresses(self.records, tx_rows, prev_outputs)
+            index_stats(self.records, prev_outputs)
+            # The UTXO set and the block store are written before the db transaction is committed. If we stop
+            # in between, they're ahead of the db and the blocks they have of more are undone on startup
+            # (see main.py).
+            if self.utxos is not None:
+                for record in self.records:
+                    connect_utxos(self.utxos, record)
+                self.utxos.flush()
+            if self.block_store is not None:
+                self.block_store.flush()
+        # The txs spent by the batch have changed, and so has the tip.
+        forget_transactions(set(input_row.prev_tx for input_row in input_rows))
+        forget_tip()
+        self.records = []
+        self.pending_txs = 0
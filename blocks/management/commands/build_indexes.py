@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from blocks.models import AddressTransaction, Transaction, TxInput, TxOutput
+
+# Models whose Meta.indexes are built by this command instead of by the migrations
+# (see migrations 0004, 0006 and 0007).
+MODELS = [Transaction, TxInput, TxOutput, AddressTransaction]
+# Indexes of those models that are built by the migrations, and so are never dropped (see migration 0007).
+MIGRATION_INDEXES = {'transaction_hash_id_idx'}
+
+
+# Returns the names of the indexes a failed CREATE INDEX CONCURRENTLY left behind. Postgres keeps them
+# (marked as invalid) and never uses them, so they need to be dropped and built again.
+def invalid_indexes(cursor):
+    cursor.execute(
+        'SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid')
+    return set(row[0] for row in cursor.fetchall())
+
+
+class Command(BaseCommand):
+    help = ('Builds the lookup indexes of the blocks tables. Run it once the initial sync is done. '
+            'On Postgres the tables are not locked while the indexes are built.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drop', action='store_true',
+                            help='Drops the indexes instead, e.g. before syncing from scratch again.')
+
+    def handle(self, *args, **options):
+        postgresql = connection.vendor == 'postgresql'
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+        with connection.schema_editor(atomic=False) as schema_editor:
+            for model in MODELS:
+                with connection.cursor() as cursor:
+                    existing = connection.introspection.get_constraints(cursor, model._meta.db_table)
+                    invalid = invalid_indexes(cursor) if postgresql else set()
+                for index in model._meta.indexes:
+                    if index.name in MIGRATION_INDEXES:
+                        continue
+                    if index.name in existing and (options['drop'] or index.name in invalid):
+                        self.stdout.write('dropping {}'.format(index.name))
+                        if postgresql:
+                            schema_editor.remove_index(model, index, concurrently=True)
+                        else:
+                            schema_editor.remove_index(model, index)
+                        del existing[index.name]
+                    if options['drop'] or index.name in existing:
+                        continue
+                    self.stdout.write('building {}...'.format(index.name))
+                    start = time.time()
+                    if postgresql:
+                        schema_editor.add_index(model, index, concurrently=True)
+                    else:
+                        schema_editor.add_index(model, index)
+                    self.stdout.write('built {} in {:.0f}s'.format(index.name, time.time() - start))
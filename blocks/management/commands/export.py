@@ -0,0 +1,124 @@
+import csv
+import glob
+import gzip
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+
+from blocks.models import BlockRow, Transaction, TxInput, TxOutput
+
+# Rows fetched from the db at a time. On Postgres, .iterator() reads them through a server-side cursor,
+# so a range never has to fit in memory.
+CHUNK_SIZE = 10000
+
+# What is exported of each table: (model, height lookup, columns). Hashes and scripts are written in hex,
+# and rows point to their tx by hash, so the files can be used without the db's primary keys.
+TABLES = {
+    'blocks': (BlockRow, 'height', [
+        'height', 'hash_id', 'version', 'prev_block', 'merkle_root', 'timestamp', 'bits', 'nonce', 'txn_count']),
+    'transactions': (Transaction, 'block__height', [
+        'block__height', 'hash_id', 'version', 'locktime', 'segwit']),
+    'inputs': (TxInput, 'transaction__block__height', [
+        'transaction__hash_id', 'prev_tx', 'prev_index', 'script_sig', 'sequence', 'witness']),
+    'outputs': (TxOutput, 'transaction__block__height', [
+        'transaction__hash_id', 'index', 'output_type', 'amount', 'address', 'script_pubkey', 'op_return_data']),
+}
+
+
+def file_name(out_dir, table, start, end):
+    return os.path.join(out_dir, '{}-{:09d}-{:09d}.csv.gz'.format(table, start, end))
+
+
+# Writes the rows of the given table for the blocks from start to end (inclusive) to a gzipped CSV file.
+# The file is written under a temporary name and renamed once complete, so a file that exists is whole.
+def export_table(out_dir, table, start, end):
+    model, height_lookup, columns = TABLES[table]
+    rows = model.objects.filter(**{height_lookup + '__gte': start, height_lookup + '__lte': end}) \
+        .order_by('pk_id').values_list(*columns)
+    path = file_name(out_dir, table, start, end)
+    count = 0
+    with gzip.open(path + '.tmp', 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([column.replace('__', '_') for column in columns])
+        for row in rows.iterator(chunk_size=CHUNK_SIZE):
+            writer.writerow([bytes(value).hex() if isinstance(value, (bytes, memoryview)) else value
+                             for value in row])
+            count += 1
+    os.replace(path + '.tmp', path)
+    return count
+
+
+# Exports every table for a range of heights. Runs in a worker process.
+def export_range(out_dir, tables, start, end):
+    counts = {}
+    for table in tables:
+        counts[table] = export_table(out_dir, table, start, end)
+    return start, end, counts
+
+
+class Command(BaseCommand):
+    help = ('Exports the saved blocks, txs, inputs and outputs to gzipped CSV files, one file per table and '
+            'range of heights, exporting several ranges in parallel. Ranges already exported are skipped, '
+            'so an interrupted export can be run again to finish it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('out_dir', help='Directory where the files are written.')
+        parser.add_argument('--from-height', type=int, default=None,
+                            help='Exports from the start of the range this height is in.')
+        parser.add_argument('--to-height', type=int, default=None)
+        parser.add_argument('--range-size', type=int, default=10000,
+                            help='Number of blocks in each file. Ranges are aligned to multiples of it.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of ranges exported at the same time.')
+        parser.add_argument('--tables', default=','.join(TABLES),
+                            help='Comma separated tables to export, among {}.'.format(', '.join(TABLES)))
+
+    def handle(self, *args, **options):
+        out_dir = options['out_dir']
+        tables = options['tables'].split(',')
+        for table in tables:
+            if table not in TABLES:
+                raise CommandError('unknown table: {}'.format(table))
+        size = options['range_size']
+        if size <= 0:
+            raise CommandError('--range-size must be positive')
+        heights = BlockRow.objects.aggregate(Min('height'), Max('height'))
+        if heights['height__max'] is None:
+            self.stdout.write('no blocks to export')
+            return
+        first = options['from_height'] if options['from_height'] is not None else heights['height__min']
+        last = options['to_height'] if options['to_height'] is not None else heights['height__max']
+        os.makedirs(out_dir, exist_ok=True)
+        # Whole ranges are exported, even when --from-height is in the middle of one, so that the files of
+        # a later run line up with these and are skipped instead of overlapping them.
+        first -= first % size
+        ranges = []
+        for start in range(first, last + 1, size):
+            end = min(start + size - 1, last)
+            if all(os.path.exists(file_name(out_dir, table, start, end)) for table in tables):
+                continue
+            # Files of the same range that ended lower (the chain has grown since) or were left unfinished
+            # are replaced.
+            for table in tables:
+                for path in glob.glob(os.path.join(out_dir, '{}-{:09d}-*.csv.gz*'.format(table, start))):
+                    os.remove(path)
+            ranges.append((start, end))
+        self.stdout.write('exporting {} ranges from height {} to {}'.format(len(ranges), first, last))
+        if len(ranges) == 0:
+            return
+        begin = time.time()
+        # The workers are forked and open their own db connections, so ours must not be shared with them.
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=min(options['workers'], len(ranges)), mp_context=context) as pool:
+            futures = [pool.submit(export_range, out_dir, tables, start, end) for start, end in ranges]
+            for future in as_completed(futures):
+                start, end, counts = future.result()
+                self.stdout.write('exported {} to {}: {}'.format(
+                    start, end, ', '.join('{} {}'.format(count, table) for table, count in counts.items())))
+        self.stdout.write('done in {:.0f}s'.format(time.time() - begin))
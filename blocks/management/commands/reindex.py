@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import time
+from io import BytesIO
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from blocks.ingest import BlockWriter, block_to_record, delete_everything, load_tip
+from library.block import Block
+from library.blockparser import parse_block
+from library.blockstore import BlockStore
+from library.utxo import UtxoSet
+
+# Blocks handed to a worker at a time.
+CHUNK_SIZE = 16
+# Chunks per worker read from the store at a time, by default. The pool reads its input as fast as it can,
+# whatever the speed of the writer, so the blocks are handed to it one window at a time, and each window is
+# written before the next one is read. This bounds the blocks and records waiting in memory.
+WINDOW_CHUNKS = 4
+
+
+# Parses a block from the store and builds its record. Runs in a worker process.
+def parse_record(item):
+    height, raw_block = item
+    # ScriptSigs are only copied, so they don't need to be parsed.
+    return block_to_record(parse_block(raw_block, lazy=True), height)
+
+
+class Command(BaseCommand):
+    help = ('Saves the blocks of the local block store to the db, without downloading them again. Blocks are '
+            'parsed by a pool of worker processes and written by a single writer, from the block after the '
+            'last saved one, so an interrupted reindex can be run again to finish it. To rebuild the db from '
+            'scratch (e.g. after a schema change), use --reset, and drop the lookup indexes with '
+            'build_indexes --drop first and build them again once done.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store', default=os.environ.get('BLOCK_STORE_DIR', 'blockstore'),
+                            help='Directory of the block store.')
+        parser.add_argument('--utxo-file', default=os.environ.get('UTXO_FILE', 'utxos.sqlite'),
+                            help='UTXO set updated with the blocks, like main.py does.')
+        parser.add_argument('--to-height', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--window', type=int, default=None,
+                            help='Blocks read from the store at a time (by default, {} chunks of {} blocks per '
+                                 'worker).'.format(WINDOW_CHUNKS, CHUNK_SIZE))
+        parser.add_argument('--reset', action='store_true',
+                            help='Deletes every saved block, and the UTXO set, first.')
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['store']):
+            raise CommandError('no block store in {}'.format(options['store']))
+        block_store = BlockStore(options['store'])
+        if options['reset']:
+            self.stdout.write('deleting the saved blocks...')
+            delete_everything()
+            # It can't be rewound further than a few blocks, and it's rebuilt with the blocks anyway.
+            if os.path.exists(options['utxo_file']):
+                os.remove(options['utxo_file'])
+        tip = load_tip()
+        end = block_store.height if options['to_height'] is None else min(options['to_height'], block_store.height)
+        if tip.height >= end:
+            self.stdout.write('nothing to reindex: the db is at height {} and the store at {}'.format(
+                tip.height, block_store.height))
+            return
+        if tip.height > 0 and block_store.height_of(tip.hash) != tip.height:
+            raise CommandError('the last saved block, at height {}, is not in the block store'.format(tip.height))
+        writer = BlockWriter()
+        # Same as in main.py: the UTXO set is updated if it's at the same height as the db.
+        utxos = UtxoSet(options['utxo_file'])
+        if utxos.height > tip.height:
+            try:
+                utxos.rewind(tip.height)
+                utxos.flush()
+            except ValueError as e:
+                self.stdout.write('could not rewind {}: {}'.format(utxos, e))
+        if utxos.height == tip.height:
+            writer.utxos = utxos
+        else:
+            self.stdout.write('{} is not at the height of the db ({}), not updating it'.format(utxos, tip.height))
+        start = tip.height + 1
+        self.stdout.write('reindexing blocks {} to {}'.format(start, end))
+
+        window = options['window'] or options['workers'] * CHUNK_SIZE * WINDOW_CHUNKS
+
+        # Checks each block comes right after the previous one (and its PoW) before it's sent to a worker.
+        def checked(stored_blocks):
+            for height, raw_block in stored_blocks:
+                tip.connect(Block.parse(BytesIO(raw_block[:80])))
+                yield height, raw_block
+
+        begin = time.time()
+        # The workers are forked, and must not share our db connection.
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with context.Pool(options['workers']) as pool:
+            for window_start in range(start, end + 1, window):
+                # The pool reads the blocks from another thread, so the store's index is queried here.
+                stored_blocks = block_store.blocks(window_start, min(window_start + window - 1, end))
+                for record in pool.imap(parse_record, checked(stored_blocks), chunksize=CHUNK_SIZE):
+                    writer.add_record(record)
+                    height = record['block']['height']
+                    if height % 1000 == 0:
+                        self.stdout.write('height {} ({:.0f} blocks/s)'.format(
+                            height, (height - start + 1) / max(time.time() - begin, 1)))
+        writer.flush()
+        utxos.close()
+        block_store.close()
+        self.stdout.write('reindexed up to height {} in {:.0f}s'.format(end, time.time() - begin))
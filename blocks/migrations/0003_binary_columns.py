@@ -0,0 +1,87 @@
+from django.db import migrations, models
+
+# Hashes and scripts were stored as hex strings. They become the bytes the hex represents.
+COLUMNS = [
+    ('blockrow', 'hash_id', models.BinaryField(max_length=32, unique=True)),
+    ('blockrow', 'prev_block', models.BinaryField(max_length=32)),
+    ('blockrow', 'merkle_root', models.BinaryField(max_length=32)),
+    ('transaction', 'hash_id', models.BinaryField(max_length=32)),
+    ('txinput', 'prev_tx', models.BinaryField(max_length=32)),
+    ('txinput', 'script_sig', models.BinaryField()),
+    ('txinput', 'witness', models.BinaryField(blank=True, default=None, null=True)),
+    ('txoutput', 'script_pubkey', models.BinaryField()),
+]
+
+
+# On Postgres the db converts the values while it rewrites each table, with decode/encode. A unique
+# varchar column also has a varchar_pattern_ops index (for LIKE queries), which can't be kept on bytea.
+def alter_postgresql(model, name, schema_editor, to_binary):
+    table = model._meta.db_table
+    like_index = schema_editor._create_index_name(table, [name], suffix='_like')
+    if to_binary:
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(schema_editor.quote_name(like_index)))
+        sql = "ALTER TABLE {0} ALTER COLUMN {1} TYPE bytea USING decode({1}, 'hex')"
+    else:
+        sql = "ALTER TABLE {0} ALTER COLUMN {1} TYPE varchar(200) USING encode({1}, 'hex')"
+    schema_editor.execute(sql.format(schema_editor.quote_name(table), schema_editor.quote_name(name)))
+    if not to_binary and model._meta.get_field(name).unique:
+        schema_editor.execute('CREATE INDEX {} ON {} ({} varchar_pattern_ops)'.format(
+            schema_editor.quote_name(like_index), schema_editor.quote_name(table), schema_editor.quote_name(name)))
+
+
+# Other dbs are only used for small development datasets, so the values are converted row by row.
+def alter_other(model, name, binary_field, schema_editor, to_binary):
+    char_field = model._meta.get_field(name)
+    binary_field = binary_field.clone()
+    binary_field.set_attributes_from_name(name)
+    binary_field.model = model
+    sql = 'UPDATE {} SET {} = %s WHERE pk_id = %s'.format(
+        schema_editor.quote_name(model._meta.db_table), schema_editor.quote_name(name))
+    with schema_editor.connection.cursor() as cursor:
+        for pk_id, value in model.objects.exclude(**{name: None}).values_list('pk_id', name):
+            if to_binary:
+                value = bytes.fromhex(value)
+            else:
+                value = bytes(value).hex()
+            cursor.execute(sql, [value, pk_id])
+    if to_binary:
+        schema_editor.alter_field(model, char_field, binary_field)
+    else:
+        schema_editor.alter_field(model, binary_field, char_field)
+
+
+def convert(apps, schema_editor, to_binary):
+    # apps always has the models with the hex (char) columns, see state_operations below.
+    for model_name, name, binary_field in COLUMNS:
+        model = apps.get_model('blocks', model_name)
+        if schema_editor.connection.vendor == 'postgresql':
+            alter_postgresql(model, name, schema_editor, to_binary)
+        else:
+            alter_other(model, name, binary_field, schema_editor, to_binary)
+
+
+def to_binary(apps, schema_editor):
+    convert(apps, schema_editor, True)
+
+
+def to_hex(apps, schema_editor):
+    convert(apps, schema_editor, False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0002_auto_20191224_1625'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(to_binary, to_hex),
+            ],
+            state_operations=[
+                migrations.AlterField(model_name=model_name, name=name, field=field)
+                for model_name, name, field in COLUMNS
+            ],
+        ),
+    ]
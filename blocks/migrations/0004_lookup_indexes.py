@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+# The lookup indexes are only added to the models' state here. Keeping them updated while the initial
+# sync inserts hundreds of millions of rows would slow it down a lot, so they're built afterwards, without
+# locking the tables, with: python manage.py build_indexes
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0003_binary_columns'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='transaction',
+                    index=models.Index(fields=['hash_id'], name='transaction_hash_id_idx'),
+                ),
+                migrations.AddIndex(
+                    model_name='txinput',
+                    index=models.Index(fields=['prev_tx', 'prev_index'], name='txinput_prevout_idx'),
+                ),
+                migrations.AddIndex(
+                    model_name='txoutput',
+                    index=models.Index(condition=models.Q(address__isnull=False), fields=['address'], name='txoutput_address_idx'),
+                ),
+            ],
+        ),
+    ]
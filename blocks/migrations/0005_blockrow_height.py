@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0004_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blockrow',
+            name='height',
+            field=models.BigIntegerField(null=True),
+        ),
+        # Until now blocks were saved in order starting from height 1, with the primary key as their height.
+        migrations.RunSQL('UPDATE blocks_blockrow SET height = pk_id', migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='blockrow',
+            name='height',
+            field=models.BigIntegerField(unique=True),
+        ),
+    ]
@@ -0,0 +1,65 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Outputs were saved in the order they appear in their transaction, so their position is their order by
+# primary key within the transaction.
+FILL_OUTPUT_INDEX = '''
+UPDATE blocks_txoutput SET "index" = numbered.position
+FROM (
+    SELECT pk_id, ROW_NUMBER() OVER (PARTITION BY transaction_id ORDER BY pk_id) - 1 AS position
+    FROM blocks_txoutput
+) AS numbered
+WHERE blocks_txoutput.pk_id = numbered.pk_id
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0005_blockrow_height'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='txoutput',
+            name='index',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunSQL(FILL_OUTPUT_INDEX, migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='txoutput',
+            name='index',
+            field=models.BigIntegerField(),
+        ),
+        migrations.CreateModel(
+            name='Address',
+            fields=[
+                ('pk_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('address', models.CharField(max_length=200, unique=True)),
+                ('balance', models.BigIntegerField(default=0)),
+                ('received', models.BigIntegerField(default=0)),
+                ('sent', models.BigIntegerField(default=0)),
+                ('tx_count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AddressTransaction',
+            fields=[
+                ('pk_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('height', models.BigIntegerField()),
+                ('received', models.BigIntegerField()),
+                ('sent', models.BigIntegerField()),
+                ('address', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='blocks.address')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='blocks.transaction')),
+            ],
+        ),
+        # Like the indexes of migration 0004, the history index is built by the build_indexes command.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='addresstransaction',
+                    index=models.Index(fields=['address', '-height', '-transaction'], name='addresstx_history_idx'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+# The writer looks up the outputs spent by each batch by the hash of their tx, and so does rollback, so the
+# index on the hash is needed during the initial sync too. Unlike the other lookup indexes (see migration
+# 0004) it's built here, before it's used to fill spent_by. It might already exist, built by build_indexes.
+CREATE_HASH_INDEX = 'CREATE INDEX IF NOT EXISTS transaction_hash_id_idx ON blocks_transaction (hash_id)'
+
+# Links the outputs saved until now to the inputs that spend them.
+FILL_SPENT_BY = '''
+UPDATE blocks_txoutput SET spent_by_id = spends.input_id
+FROM (
+    SELECT blocks_txinput.pk_id AS input_id, blocks_transaction.pk_id AS transaction_id,
+        blocks_txinput.prev_index AS prev_index
+    FROM blocks_txinput JOIN blocks_transaction ON blocks_transaction.hash_id = blocks_txinput.prev_tx
+) AS spends
+WHERE blocks_txoutput.transaction_id = spends.transaction_id AND blocks_txoutput."index" = spends.prev_index
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0006_address_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='txoutput',
+            name='spent_by',
+            field=models.ForeignKey(blank=True, db_index=False, default=None, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='spent_outputs', to='blocks.txinput'),
+        ),
+        migrations.RunSQL(CREATE_HASH_INDEX, migrations.RunSQL.noop),
+        migrations.RunSQL(FILL_SPENT_BY, migrations.RunSQL.noop),
+        # Like the indexes of migration 0004, this index is built by the build_indexes command.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='txoutput',
+                    index=models.Index(condition=models.Q(spent_by__isnull=False), fields=['spent_by'], name='txoutput_spent_by_idx'),
+                ),
+            ],
+        ),
+    ]
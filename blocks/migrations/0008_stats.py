@@ -0,0 +1,56 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0007_txoutput_spent_by'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockStats',
+            fields=[
+                ('pk_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('height', models.BigIntegerField(unique=True)),
+                ('timestamp', models.BigIntegerField()),
+                ('tx_count', models.BigIntegerField()),
+                ('segwit_count', models.BigIntegerField()),
+                ('input_count', models.BigIntegerField()),
+                ('output_count', models.BigIntegerField()),
+                ('output_value', models.BigIntegerField()),
+                ('fees', models.BigIntegerField()),
+                ('p2pk_count', models.BigIntegerField()),
+                ('p2pkh_count', models.BigIntegerField()),
+                ('p2sh_count', models.BigIntegerField()),
+                ('p2wpkh_count', models.BigIntegerField()),
+                ('p2wsh_count', models.BigIntegerField()),
+                ('op_return_count', models.BigIntegerField()),
+                ('nonstandard_count', models.BigIntegerField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['timestamp'], name='blockstats_timestamp_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('pk_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('day', models.DateField(unique=True)),
+                ('blocks', models.BigIntegerField(default=0)),
+                ('tx_count', models.BigIntegerField(default=0)),
+                ('segwit_count', models.BigIntegerField(default=0)),
+                ('input_count', models.BigIntegerField(default=0)),
+                ('output_count', models.BigIntegerField(default=0)),
+                ('output_value', models.BigIntegerField(default=0)),
+                ('fees', models.BigIntegerField(default=0)),
+                ('p2pk_count', models.BigIntegerField(default=0)),
+                ('p2pkh_count', models.BigIntegerField(default=0)),
+                ('p2sh_count', models.BigIntegerField(default=0)),
+                ('p2wpkh_count', models.BigIntegerField(default=0)),
+                ('p2wsh_count', models.BigIntegerField(default=0)),
+                ('op_return_count', models.BigIntegerField(default=0)),
+                ('nonstandard_count', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
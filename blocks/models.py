@@ -4,38 +4,142 @@ from django.db import models
 
 class BlockRow(models.Model):
     pk_id = models.BigAutoField(primary_key=True)
-    hash_id = models.CharField(max_length=200, unique=True)
+    # Hashes and scripts are stored as raw bytes (hashes in the same byte order they're shown in hex).
+    hash_id = models.BinaryField(max_length=32, unique=True)
     version = models.BigIntegerField()
-    prev_block = models.CharField(max_length=200)
-    merkle_root = models.CharField(max_length=200)
+    prev_block = models.BinaryField(max_length=32)
+    merkle_root = models.BinaryField(max_length=32)
     timestamp = models.BigIntegerField()
     bits = models.CharField(max_length=200)
     nonce = models.CharField(max_length=200)
     txn_count = models.BigIntegerField()
+    # Height in the chain (the genesis block, which is never saved, is at height 0).
+    height = models.BigIntegerField(unique=True)
 
 
 class Transaction(models.Model):
     pk_id = models.BigAutoField(primary_key=True)
     block = models.ForeignKey(BlockRow, on_delete=models.CASCADE)
-    hash_id = models.CharField(max_length=200)
+    hash_id = models.BinaryField(max_length=32)
     version = models.BigIntegerField()
     locktime = models.BigIntegerField()
     segwit = models.BooleanField()
 
+    class Meta:
+        # Unlike the other lookup indexes, this one is built by the migrations (see migration 0007): the
+        # writer needs it to find the outputs spent by each batch.
+        indexes = [
+            models.Index(fields=['hash_id'], name='transaction_hash_id_idx'),
+        ]
+
 class TxInput(models.Model):
     pk_id = models.BigAutoField(primary_key=True)
     transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE)
-    prev_tx = models.CharField(max_length=200)
+    prev_tx = models.BinaryField(max_length=32)
     prev_index = models.BigIntegerField()
-    script_sig = models.CharField(max_length=200)
+    script_sig = models.BinaryField()
     sequence = models.BigIntegerField()
-    witness = models.CharField(max_length=200, default=None, blank=True, null=True)
+    witness = models.BinaryField(default=None, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # To find the input that spends an output.
+            models.Index(fields=['prev_tx', 'prev_index'], name='txinput_prevout_idx'),
+        ]
 
 class TxOutput(models.Model):
     pk_id = models.BigAutoField(primary_key=True)
     transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE)
+    # Position of the output in its transaction, which is how inputs refer to it (prev_index).
+    index = models.BigIntegerField()
     output_type = models.CharField(max_length=200)
     amount = models.BigIntegerField()
     address = models.CharField(max_length=200, default=None, blank=True, null=True)
-    script_pubkey = models.CharField(max_length=200)
-    op_return_data = models.CharField(max_length=200, default=None, blank=True, null=True)
\ No newline at end of file
+    script_pubkey = models.BinaryField()
+    op_return_data = models.CharField(max_length=200, default=None, blank=True, null=True)
+    # The input that spends this output, None while it's unspent. Rolling back blocks unsets it before
+    # deleting the inputs (see ingest.rollback), so the db doesn't need to look for outputs on every delete.
+    spent_by = models.ForeignKey(TxInput, on_delete=models.DO_NOTHING, default=None, blank=True, null=True,
+                                 db_index=False, related_name='spent_outputs')
+
+    class Meta:
+        indexes = [
+            # OP_RETURN and non standard outputs have no address, so they're left out of the index.
+            models.Index(fields=['address'], name='txoutput_address_idx', condition=models.Q(address__isnull=False)),
+            # To find the output an input spends.
+            models.Index(fields=['spent_by'], name='txoutput_spent_by_idx', condition=models.Q(spent_by__isnull=False)),
+        ]
+
+
+# Totals of every address that ever received coins, kept up to date while blocks are saved.
+class Address(models.Model):
+    pk_id = models.BigAutoField(primary_key=True)
+    address = models.CharField(max_length=200, unique=True)
+    balance = models.BigIntegerField(default=0)
+    received = models.BigIntegerField(default=0)
+    sent = models.BigIntegerField(default=0)
+    tx_count = models.BigIntegerField(default=0)
+
+
+# What each transaction did to each address it touched: the history of an address.
+class AddressTransaction(models.Model):
+    pk_id = models.BigAutoField(primary_key=True)
+    # The history index below starts with the address, so it also serves the foreign key.
+    address = models.ForeignKey(Address, on_delete=models.CASCADE, db_index=False)
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE)
+    height = models.BigIntegerField()
+    received = models.BigIntegerField()
+    sent = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['address', '-height', '-transaction'], name='addresstx_history_idx'),
+        ]
+
+
+# Totals of each block, kept up to date while blocks are saved (see stats.py).
+class BlockStats(models.Model):
+    pk_id = models.BigAutoField(primary_key=True)
+    height = models.BigIntegerField(unique=True)
+    timestamp = models.BigIntegerField()
+    tx_count = models.BigIntegerField()
+    segwit_count = models.BigIntegerField()
+    input_count = models.BigIntegerField()
+    output_count = models.BigIntegerField()
+    # Sum of the amounts of every output, coinbase included.
+    output_value = models.BigIntegerField()
+    # Sum of the fees of the txs whose spent outputs were all found.
+    fees = models.BigIntegerField()
+    # Number of outputs of each type (see ingest.describe_output).
+    p2pk_count = models.BigIntegerField()
+    p2pkh_count = models.BigIntegerField()
+    p2sh_count = models.BigIntegerField()
+    p2wpkh_count = models.BigIntegerField()
+    p2wsh_count = models.BigIntegerField()
+    op_return_count = models.BigIntegerField()
+    nonstandard_count = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['timestamp'], name='blockstats_timestamp_idx'),
+        ]
+
+
+# The same totals by day (UTC, by block timestamp), plus the number of blocks.
+class DailyStats(models.Model):
+    pk_id = models.BigAutoField(primary_key=True)
+    day = models.DateField(unique=True)
+    blocks = models.BigIntegerField(default=0)
+    tx_count = models.BigIntegerField(default=0)
+    segwit_count = models.BigIntegerField(default=0)
+    input_count = models.BigIntegerField(default=0)
+    output_count = models.BigIntegerField(default=0)
+    output_value = models.BigIntegerField(default=0)
+    fees = models.BigIntegerField(default=0)
+    p2pk_count = models.BigIntegerField(default=0)
+    p2pkh_count = models.BigIntegerField(default=0)
+    p2sh_count = models.BigIntegerField(default=0)
+    p2wpkh_count = models.BigIntegerField(default=0)
+    p2wsh_count = models.BigIntegerField(default=0)
+    op_return_count = models.BigIntegerField(default=0)
+    nonstandard_count = models.BigIntegerField(default=0)
@@ -0,0 +1,76 @@
+from collections import OrderedDict, defaultdict
+
+from .batches import LOOKUP_BATCH_SIZE
+from .models import TxOutput
+
+COINBASE_PREV_TX = b'\x00' * 32
+
+
+# Returns whether the outpoint (prev tx hash, prev index) of an input is the one of a coinbase input,
+# which doesn't spend any output.
+def is_coinbase_outpoint(outpoint):
+    return outpoint[0] == COINBASE_PREV_TX
+
+
+# Loads the saved outputs spent by the given outpoints. Returns a dict with (pk_id, address, amount) by
+# outpoint. Outpoints that are not found are left out. Outputs are found through the index on the
+# transactions' hash (built by the migrations, so it's there during the initial sync) and the one on
+# their foreign key.
+def load_outputs(outpoints):
+    indexes_by_tx = defaultdict(set)
+    for prev_tx, prev_index in outpoints:
+        indexes_by_tx[prev_tx].add(prev_index)
+    hashes = list(indexes_by_tx)
+    outputs = {}
+    for i in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+        rows = TxOutput.objects.filter(transaction__hash_id__in=hashes[i:i + LOOKUP_BATCH_SIZE]).values_list(
+            'transaction__hash_id', 'index', 'pk_id', 'address', 'amount')
+        for hash_id, index, pk_id, address, amount in rows:
+            # The db driver can return a memoryview instead of bytes.
+            hash_id = bytes(hash_id)
+            if index in indexes_by_tx[hash_id]:
+                outputs[(hash_id, index)] = (pk_id, address, amount)
+    return outputs
+
+
+# Saved outputs that can still be spent, by outpoint: (prev tx hash, prev index) -> (pk_id, address, amount).
+# Most outputs are spent a few blocks after they're created, so the latest ones are kept in memory, up to
+# max_size of them (the least recently added ones are dropped first). The rest are loaded from the db.
+class OutpointMap:
+
+    def __init__(self, max_size=1000000):
+        self.max_size = max_size
+        self.outputs = OrderedDict()
+        # Number of outpoints found in memory and loaded from the db.
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.outputs)
+
+    # Adds a saved output that can be spent.
+    def add(self, outpoint, output):
+        self.outputs[outpoint] = output
+        if len(self.outputs) > self.max_size:
+            self.outputs.popitem(last=False)
+
+    # Returns the outputs spent by the given outpoints, as a dict by outpoint (see load_outputs). An output
+    # can only be spent once, so the ones found in memory are removed.
+    def spend(self, outpoints):
+        found = {}
+        missing = []
+        for outpoint in outpoints:
+            output = self.outputs.pop(outpoint, None)
+            if output is None:
+                missing.append(outpoint)
+            else:
+                found[outpoint] = output
+        self.hits += len(found)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            found.update(load_outputs(missing))
+        return found
+
+    # Forgets every output, e.g. after a rollback, when some of them might not exist anymore.
+    def clear(self):
+        self.outputs.clear()
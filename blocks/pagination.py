@@ -0,0 +1,26 @@
+from rest_framework.pagination import CursorPagination
+
+
+# Pages through the blocks by height (which is unique) with a cursor, so that a page is found through the
+# height index wherever it is, and no COUNT(*) is needed. ?ordering=-height is honoured.
+class BlockCursorPagination(CursorPagination):
+    ordering = 'height'
+
+
+# Pages through transactions (or inputs, or outputs) in the order they were saved, which is their order
+# in the chain.
+class TransactionCursorPagination(CursorPagination):
+    ordering = 'pk_id'
+
+
+class DayCursorPagination(CursorPagination):
+    ordering = 'day'
+
+
+class AddressCursorPagination(CursorPagination):
+    ordering = 'pk_id'
+
+
+# Pages through the history of an address, latest first, along the (address, -height, -transaction) index.
+class AddressHistoryCursorPagination(CursorPagination):
+    ordering = ('-height', '-transaction_id')
@@ -1,8 +1,131 @@
-from .models import BlockRow
+from .models import Address, AddressTransaction, BlockRow, BlockStats, DailyStats, Transaction, TxInput, TxOutput
 from rest_framework import serializers
+from .stats import OUTPUT_TYPE_FIELDS
 
 
-class BlockSerializer(serializers.HyperlinkedModelSerializer):
+# Hashes and scripts are stored as bytes, but the API shows them (and receives them) in hex.
+class HexField(serializers.Field):
+
+    default_error_messages = {
+        'invalid': 'Not a valid hex string.',
+    }
+
+    def to_representation(self, value):
+        # The db driver can return a memoryview instead of bytes.
+        return bytes(value).hex()
+
+    def to_internal_value(self, data):
+        try:
+            return bytes.fromhex(data)
+        except (TypeError, ValueError):
+            self.fail('invalid')
+
+
+class BlockSerializer(serializers.ModelSerializer):
+    hash_id = HexField()
+    prev_block = HexField()
+    merkle_root = HexField()
+
     class Meta:
         model = BlockRow
-        fields = ['pk_id', 'hash_id', 'version', 'prev_block', 'merkle_root', 'timestamp', 'bits', 'nonce', 'txn_count']
+        fields = ['pk_id', 'height', 'hash_id', 'version', 'prev_block', 'merkle_root', 'timestamp', 'bits', 'nonce', 'txn_count']
+
+
+# Read-only serializer for lists of blocks, built from .values() rows instead of model instances. It
+# skips the per-field machinery of BlockSerializer, but gives the same representation.
+class BlockListSerializer(serializers.BaseSerializer):
+    FIELDS = ['pk_id', 'height', 'hash_id', 'version', 'prev_block', 'merkle_root', 'timestamp', 'bits', 'nonce', 'txn_count']
+    HEX_FIELDS = {'hash_id', 'prev_block', 'merkle_root'}
+
+    def to_representation(self, row):
+        return {field: bytes(row[field]).hex() if field in self.HEX_FIELDS else row[field] for field in self.FIELDS}
+
+
+# The output spent by an input, as shown with the input.
+class SpentOutputSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TxOutput
+        fields = ['address', 'amount']
+
+
+class TxInputSerializer(serializers.ModelSerializer):
+    prev_tx = HexField()
+    script_sig = HexField()
+    witness = HexField(allow_null=True)
+    spent_output = serializers.SerializerMethodField()
+
+    class Meta:
+        model = TxInput
+        fields = ['prev_tx', 'prev_index', 'script_sig', 'sequence', 'witness', 'spent_output']
+
+    # None for coinbase inputs. Uses the prefetched spent_outputs (see TransactionViewSet and TxInputViewSet).
+    def get_spent_output(self, tx_input):
+        for tx_output in tx_input.spent_outputs.all():
+            return SpentOutputSerializer(tx_output).data
+        return None
+
+
+class TxOutputSerializer(serializers.ModelSerializer):
+    script_pubkey = HexField()
+    # The tx that spends the output, None while it's unspent.
+    spent_by_tx = HexField(source='spent_by.transaction.hash_id', allow_null=True)
+
+    class Meta:
+        model = TxOutput
+        fields = ['index', 'output_type', 'amount', 'address', 'script_pubkey', 'op_return_data', 'spent_by_tx']
+
+
+# An input on its own (see TxInputViewSet), with its id and the id of its tx.
+class TxInputDetailSerializer(TxInputSerializer):
+    tx_id = HexField(source='transaction.hash_id')
+
+    class Meta(TxInputSerializer.Meta):
+        fields = ['pk_id', 'tx_id'] + TxInputSerializer.Meta.fields
+
+
+# An output on its own (see TxOutputViewSet), with its id and the id of its tx.
+class TxOutputDetailSerializer(TxOutputSerializer):
+    tx_id = HexField(source='transaction.hash_id')
+
+    class Meta(TxOutputSerializer.Meta):
+        fields = ['pk_id', 'tx_id'] + TxOutputSerializer.Meta.fields
+
+
+class TransactionSerializer(serializers.ModelSerializer):
+    tx_id = HexField(source='hash_id')
+    height = serializers.IntegerField(source='block.height')
+    inputs = TxInputSerializer(many=True, source='txinput_set')
+    outputs = TxOutputSerializer(many=True, source='txoutput_set')
+
+    class Meta:
+        model = Transaction
+        fields = ['tx_id', 'height', 'version', 'locktime', 'segwit', 'inputs', 'outputs']
+
+
+class AddressSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Address
+        fields = ['address', 'balance', 'received', 'sent', 'tx_count']
+
+
+# A row of the history of an address.
+class AddressTransactionSerializer(serializers.ModelSerializer):
+    tx_id = HexField(source='transaction.hash_id')
+
+    class Meta:
+        model = AddressTransaction
+        fields = ['tx_id', 'height', 'received', 'sent']
+
+
+class BlockStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BlockStats
+        fields = ['height', 'timestamp', 'tx_count', 'segwit_count', 'input_count', 'output_count', 'output_value',
+                  'fees'] + list(OUTPUT_TYPE_FIELDS.values())
+
+
+class DailyStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DailyStats
+        fields = ['day', 'blocks', 'tx_count', 'segwit_count', 'input_count', 'output_count', 'output_value',
+                  'fees'] + list(OUTPUT_TYPE_FIELDS.values())
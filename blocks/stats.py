@@ -0,0 +1,101 @@
+from datetime import datetime, timezone
+
+from .batches import WRITE_BATCH_SIZE
+from .models import BlockStats, DailyStats
+from .outpoints import is_coinbase_outpoint
+
+# Field that counts the outputs of each type (see ingest.describe_output).
+OUTPUT_TYPE_FIELDS = {
+    'P2PK': 'p2pk_count',
+    'P2PKH': 'p2pkh_count',
+    'P2SH': 'p2sh_count',
+    'P2WPKH': 'p2wpkh_count',
+    'P2WSH': 'p2wsh_count',
+    'OP_RETURN': 'op_return_count',
+    'NONSTANDARD': 'nonstandard_count',
+}
+# Totals that are added up from blocks into days.
+TOTALS = ['tx_count', 'segwit_count', 'input_count', 'output_count', 'output_value', 'fees'] + \
+    list(OUTPUT_TYPE_FIELDS.values())
+
+
+# UTC day of a block timestamp.
+def day_of(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).date()
+
+
+# Returns the totals of a block record (see ingest.block_to_record) as a dict with the fields of BlockStats.
+# prev_outputs has the (address, amount) of the outputs spent by the block, by outpoint.
+def block_stats(record, prev_outputs):
+    stats = {field: 0 for field in TOTALS}
+    for tx in record['txs']:
+        stats['tx_count'] += 1
+        if tx['tx']['segwit']:
+            stats['segwit_count'] += 1
+        stats['input_count'] += len(tx['inputs'])
+        stats['output_count'] += len(tx['outputs'])
+        total_output = 0
+        for tx_out in tx['outputs']:
+            total_output += tx_out['amount']
+            stats[OUTPUT_TYPE_FIELDS.get(tx_out['output_type'], 'nonstandard_count')] += 1
+        stats['output_value'] += total_output
+        total_input = 0
+        for tx_in in tx['inputs']:
+            outpoint = (tx_in['prev_tx'], tx_in['prev_index'])
+            if is_coinbase_outpoint(outpoint):
+                total_input = None
+                break
+            prev_output = prev_outputs.get(outpoint)
+            # Outputs that couldn't be found were already reported by the writer.
+            if prev_output is None:
+                total_input = None
+                break
+            total_input += prev_output[1]
+        if total_input is not None:
+            stats['fees'] += total_input - total_output
+    stats['height'] = record['block']['height']
+    stats['timestamp'] = record['block']['timestamp']
+    return stats
+
+
+# Adds (sign=1) or removes (sign=-1) the totals of some blocks to the rows of their days, given as a
+# dict by day. Returns the rows that became empty.
+def add_to_days(day_rows, blocks, sign=1):
+    for stats in blocks:
+        day_row = day_rows[day_of(stats['timestamp'])]
+        day_row.blocks += sign
+        for field in TOTALS:
+            setattr(day_row, field, getattr(day_row, field) + sign * stats[field])
+    return [day_row for day_row in day_rows.values() if day_row.blocks == 0]
+
+
+# Saves the stats of a batch of block records and adds them to the daily stats. Called by the writer once
+# the rows of the batch are saved.
+def index_stats(records, prev_outputs):
+    blocks = [block_stats(record, prev_outputs) for record in records]
+    BlockStats.objects.bulk_create([BlockStats(**stats) for stats in blocks], batch_size=WRITE_BATCH_SIZE)
+    days = set(day_of(stats['timestamp']) for stats in blocks)
+    day_rows = {day_row.day: day_row for day_row in DailyStats.objects.filter(day__in=days)}
+    existing = list(day_rows.values())
+    new = []
+    for day in days:
+        if day not in day_rows:
+            day_rows[day] = DailyStats(day=day)
+            new.append(day_rows[day])
+    add_to_days(day_rows, blocks)
+    DailyStats.objects.bulk_update(existing, ['blocks'] + TOTALS, batch_size=WRITE_BATCH_SIZE)
+    DailyStats.objects.bulk_create(new, batch_size=WRITE_BATCH_SIZE)
+
+
+# Removes the stats of the blocks above the given height, from their days too. Called from ingest.rollback.
+def rollback_stats(height):
+    rows = BlockStats.objects.filter(height__gt=height)
+    blocks = list(rows.values('timestamp', *TOTALS))
+    if len(blocks) == 0:
+        return
+    days = set(day_of(stats['timestamp']) for stats in blocks)
+    day_rows = {day_row.day: day_row for day_row in DailyStats.objects.filter(day__in=days)}
+    empty = add_to_days(day_rows, blocks, sign=-1)
+    DailyStats.objects.bulk_update(list(day_rows.values()), ['blocks'] + TOTALS, batch_size=WRITE_BATCH_SIZE)
+    DailyStats.objects.filter(pk_id__in=[day_row.pk_id for day_row in empty]).delete()
+    rows.delete()
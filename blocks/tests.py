@@ -1,3 +1,419 @@
-from django.test import TestCase
+import csv
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import date
+from io import StringIO
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+
+from library.blockparser import parse_block
+from library.blockstore import BlockStore
+from library import chain
+from library.helper import encode_varint, h160_to_p2pkh_address, hash160
+from library.network import BlockMessage
+from library.script import Script, p2pkh_script
+from library.tx import Tx, TxIn, TxOut
+
+from .caching import FINAL_TIMEOUT, RECENT_TIMEOUT
+from .ingest import BlockWriter, find_fork, load_tip, reorganize, rollback
+from .models import Address, AddressTransaction, BlockRow, BlockStats, DailyStats, Transaction, TxInput, TxOutput
+from .outpoints import OutpointMap, load_outputs
+
+# Outputs of the test txs.
+SCRIPT_X = p2pkh_script(b'\x01' * 20)
+SCRIPT_Y = p2pkh_script(b'\x02' * 20)
+
+
+# Seconds in a day, to put blocks on different days.
+DAY = 24 * 3600
+
+
+# Makes a block with the given txs on top of prev_block. Its PoW isn't valid, but the writer doesn't check it.
+def make_block(prev_block, txs, timestamp=0):
+    return BlockMessage(1, prev_block, b'\x00' * 32, timestamp, b'\xff\xff\x00\x1d', b'\x00' * 4, len(txs), txs)
+
+
+def make_coinbase(height, amount=5000, script_pubkey=SCRIPT_X):
+    return Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([bytes([height])]))], [TxOut(amount, script_pubkey)], 0)
+
+
+# Tx spending the given outpoints, with one output per amount.
+def make_spend(outpoints, amounts, script_pubkey=SCRIPT_Y):
+    return Tx(1, [TxIn(prev_tx, prev_index, Script([b'\x01'])) for prev_tx, prev_index in outpoints],
+              [TxOut(amount, script_pubkey) for amount in amounts], 0)
+
+
+# Saves a chain of blocks with just a coinbase each, from height 1. Returns the blocks.
+def write_chain(length, writer=None):
+    writer = writer or BlockWriter()
+    blocks = []
+    prev_block = b'\x00' * 32
+    for height in range(1, length + 1):
+        blocks.append(make_block(prev_block, [make_coinbase(height)], timestamp=height))
+        writer.add(blocks[-1], height)
+        prev_block = blocks[-1].hash()
+    writer.flush()
+    return blocks
+
+
+# Header chain with the given hashes, by height, for find_fork and reorganize.
+class FakeChain:
+
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    def height_of(self, block_hash):
+        for height, chain_hash in self.hashes.items():
+            if chain_hash == block_hash:
+                return height
+        return None
+
+    def hash_at(self, height):
+        return self.hashes[height]
+
+
+class WriterTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        # Block 1 has a coinbase, and block 2 a coinbase and a tx spending the first one.
+        self.coinbase = make_coinbase(1)
+        self.spend = make_spend([(self.coinbase.hash(), 0)], [3000, 1900])
+        self.blocks = [make_block(b'\x00' * 32, [self.coinbase], timestamp=1)]
+        self.blocks.append(make_block(self.blocks[0].hash(), [make_coinbase(2), self.spend], timestamp=2))
+        writer = BlockWriter()
+        for height, block in enumerate(self.blocks, start=1):
+            writer.add(block, height)
+        writer.flush()
+
+    def test_flush(self):
+        self.assertEqual(list(BlockRow.objects.order_by('height').values_list('height', 'txn_count')), [(1, 1), (2, 2)])
+        # Txs are saved in chain order.
+        self.assertEqual([bytes(tx_hash) for tx_hash in Transaction.objects.order_by('pk_id').values_list(
+            'hash_id', flat=True)], [self.coinbase.hash(), self.blocks[1].txns[0].hash(), self.spend.hash()])
+        self.assertEqual(TxInput.objects.count(), 3)
+        self.assertEqual(sorted(TxOutput.objects.values_list('amount', flat=True)), [1900, 3000, 5000, 5000])
+        tip = load_tip()
+        self.assertEqual((tip.height, tip.hash), (2, self.blocks[1].hash()))
+
+    def test_batches(self):
+        # Blocks are written as soon as a batch is full.
+        writer = BlockWriter(batch_size=2)
+        prev_block = self.blocks[1].hash()
+        for height in range(3, 6):
+            block = make_block(prev_block, [make_coinbase(height)])
+            writer.add(block, height)
+            prev_block = block.hash()
+        self.assertEqual(BlockRow.objects.count(), 4)
+        writer.flush()
+        self.assertEqual(BlockRow.objects.count(), 5)
+
+    def test_rollback(self):
+        rollback(1)
+        self.assertEqual(list(BlockRow.objects.values_list('height', flat=True)), [1])
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(TxInput.objects.count(), 1)
+        # The output block 2 spent is unspent again.
+        self.assertIsNone(TxOutput.objects.get().spent_by)
+        self.assertEqual(load_tip().height, 1)
+
+    def test_find_fork(self):
+        hashes = {1: self.blocks[0].hash(), 2: b'\x02' * 32}
+        self.assertEqual(find_fork(FakeChain(hashes), page_size=1), 1)
+        self.assertIsNone(find_fork(FakeChain({}), page_size=1))
+
+    def test_reorganize(self):
+        tip = reorganize(FakeChain({1: self.blocks[0].hash(), 2: b'\x02' * 32}), load_tip())
+        self.assertEqual((tip.height, tip.hash), (1, self.blocks[0].hash()))
+        self.assertEqual(BlockRow.objects.count(), 1)
+        # None of our blocks is in the chain anymore.
+        tip = reorganize(FakeChain({}), tip)
+        self.assertEqual(tip.height, 0)
+        self.assertEqual(BlockRow.objects.count(), 0)
+        self.assertEqual(TxOutput.objects.count(), 0)
+
+
+class AddressIndexTest(TestCase):
+
+    def test_balances(self):
+        coinbase = make_coinbase(1)
+        # Spends the coinbase in the same batch, sending the change back.
+        spend = Tx(1, [TxIn(coinbase.hash(), 0, Script([b'\x01']))], [TxOut(3000, SCRIPT_Y), TxOut(1900, SCRIPT_X)], 0)
+        block1 = make_block(b'\x00' * 32, [coinbase, spend])
+        writer = BlockWriter()
+        writer.add(block1, 1)
+        writer.flush()
+        spent = TxOutput.objects.get(transaction__hash_id=coinbase.hash())
+        self.assertEqual(bytes(spent.spent_by.transaction.hash_id), spend.hash())
+        x = Address.objects.get(address=SCRIPT_X.address())
+        self.assertEqual((x.balance, x.received, x.sent, x.tx_count), (1900, 6900, 5000, 2))
+        self.assertEqual(Address.objects.get(address=SCRIPT_Y.address()).balance, 3000)
+        # Spends Y's output in another batch.
+        spend2 = make_spend([(spend.hash(), 0)], [2500], SCRIPT_X)
+        writer.add(make_block(block1.hash(), [make_coinbase(2, script_pubkey=SCRIPT_Y), spend2]), 2)
+        writer.flush()
+        y = Address.objects.get(address=SCRIPT_Y.address())
+        self.assertEqual((y.balance, y.received, y.sent, y.tx_count), (5000, 8000, 3000, 3))
+        history = AddressTransaction.objects.filter(address=y).order_by('-height', '-transaction_id')
+        self.assertEqual([(row.height, row.received, row.sent) for row in history],
+                         [(2, 0, 3000), (2, 5000, 0), (1, 3000, 0)])
+        rollback(1)
+        y.refresh_from_db()
+        self.assertEqual((y.balance, y.received, y.sent, y.tx_count), (3000, 3000, 0, 1))
+        self.assertEqual(AddressTransaction.objects.filter(height=2).count(), 0)
+        rollback(0)
+        self.assertEqual(Address.objects.count(), 0)
+
+    def test_output_types(self):
+        public_key = b'\x02' + b'\x05' * 32
+        p2pk = Script([public_key, 0xac])
+        multisig = Script([0x51, public_key, 0x51, 0xae])
+        coinbase = Tx(1, [TxIn(b'\x00' * 32, 0xffffffff, Script([b'\x01']))],
+                      [TxOut(5000, p2pk), TxOut(1, multisig), TxOut(0, Script([])), TxOut(0, Script([106]))], 0)
+        writer = BlockWriter()
+        writer.add(make_block(b'\x00' * 32, [coinbase]), 1)
+        writer.flush()
+        # P2PK outputs are indexed under the P2PKH address of their public key.
+        p2pk_address = h160_to_p2pkh_address(hash160(public_key))
+        self.assertEqual(list(TxOutput.objects.order_by('index').values_list('output_type', 'address')), [
+            ('P2PK', p2pk_address), ('NONSTANDARD', None), ('NONSTANDARD', None), ('OP_RETURN', None)])
+        self.assertEqual(list(Address.objects.values_list('address', 'balance')), [(p2pk_address, 5000)])
+
+    def test_history(self):
+        write_chain(12)
+        # Every coinbase pays to X.
+        response = self.client.get('/addresses/{}/history/'.format(SCRIPT_X.address()))
+        self.assertEqual([row['height'] for row in response.json()['results']], list(range(12, 2, -1)))
+        response = self.client.get(response.json()['next'])
+        self.assertEqual([row['height'] for row in response.json()['results']], [2, 1])
+        response = self.client.get('/addresses/{}/'.format(SCRIPT_X.address()))
+        self.assertEqual(response.json()['balance'], 12 * 5000)
+
+
+class OutpointsTest(TestCase):
+
+    def setUp(self):
+        self.coinbase = make_coinbase(1)
+        self.block1 = make_block(b'\x00' * 32, [self.coinbase])
+        # An outpoint map with no room, so that every spent output has to be loaded from the db.
+        self.writer = BlockWriter(max_outpoints=0)
+        self.writer.add(self.block1, 1)
+        self.writer.flush()
+
+    def test_load_outputs(self):
+        output_row = TxOutput.objects.get()
+        outpoint = (self.coinbase.hash(), 0)
+        self.assertEqual(load_outputs([outpoint, (self.coinbase.hash(), 1), (b'\x05' * 32, 0)]),
+                         {outpoint: (output_row.pk_id, SCRIPT_X.address(), 5000)})
+
+    def test_spend_from_db(self):
+        outpoints = OutpointMap()
+        outpoint = (self.coinbase.hash(), 0)
+        self.assertEqual(list(outpoints.spend([outpoint]).values())[0][1:], (SCRIPT_X.address(), 5000))
+        self.assertEqual((outpoints.hits, outpoints.misses), (0, 1))
+
+    def test_writer_links_outputs_from_db(self):
+        spend = make_spend([(self.coinbase.hash(), 0)], [4000])
+        self.writer.add(make_block(self.block1.hash(), [make_coinbase(2), spend]), 2)
+        self.writer.flush()
+        self.assertEqual(self.writer.outpoints.misses, 1)
+        spent_output = TxOutput.objects.get(transaction__hash_id=self.coinbase.hash())
+        self.assertEqual(bytes(spent_output.spent_by.transaction.hash_id), spend.hash())
+        # Rolling back the block finds the output through the tx hash and makes it unspent again.
+        rollback(1)
+        spent_output.refresh_from_db()
+        self.assertIsNone(spent_output.spent_by)
+
+
+class ReindexTest(TransactionTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store_dir = os.path.join(self.directory, 'blockstore')
+        self.utxo_file = os.path.join(self.directory, 'utxos.sqlite')
+        # The first blocks of mainnet have a valid PoW, which reindex checks. Their txs are replaced by a
+        # coinbase paying to a different address each (the merkle root isn't checked).
+        store = BlockStore(self.store_dir)
+        for height, header in enumerate([chain.ChainTipTest.block1, chain.ChainTipTest.block2], start=1):
+            raw_block = header + encode_varint(1) + make_coinbase(height, script_pubkey=p2pkh_script(
+                bytes([height]) * 20)).serialize()
+            store.add(height, parse_block(raw_block).hash(), raw_block)
+        store.close()
+
+    def reindex(self, *args):
+        call_command('reindex', '--store', self.store_dir, '--utxo-file', self.utxo_file, '--workers', '1',
+                     *args, stdout=StringIO())
+
+    def test_resume(self):
+        self.reindex('--to-height', '1')
+        self.assertEqual(list(BlockRow.objects.values_list('height', flat=True)), [1])
+        # One block read from the store at a time.
+        self.reindex('--window', '1')
+        self.assertEqual(list(BlockRow.objects.order_by('height').values_list('height', flat=True)), [1, 2])
+        self.assertEqual(Address.objects.count(), 2)
+        self.assertEqual(BlockStats.objects.count(), 2)
+        out = StringIO()
+        call_command('reindex', '--store', self.store_dir, '--utxo-file', self.utxo_file, stdout=out)
+        self.assertIn('nothing to reindex', out.getvalue())
+
+    def test_reset(self):
+        self.reindex()
+        self.reindex('--reset')
+        self.assertEqual(list(BlockRow.objects.order_by('height').values_list('height', 'pk_id')), [(1, 1), (2, 2)])
+        self.assertEqual(sorted(Address.objects.values_list('balance', flat=True)), [5000, 5000])
+        self.assertEqual(BlockStats.objects.count(), 2)
+
+
+class ApiTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.blocks = write_chain(12)
+
+    def test_block_pages(self):
+        response = self.client.get('/blocks/')
+        self.assertEqual([block['height'] for block in response.json()['results']], list(range(1, 11)))
+        response = self.client.get(response.json()['next'])
+        self.assertEqual([block['height'] for block in response.json()['results']], [11, 12])
+        self.assertIsNone(response.json()['next'])
+        response = self.client.get('/blocks/?ordering=-height&min_height=3&max_height=5')
+        self.assertEqual([block['height'] for block in response.json()['results']], [5, 4, 3])
+
+    def test_block(self):
+        response = self.client.get('/blocks/2/')
+        self.assertEqual(response.json()['hash_id'], self.blocks[1].hash().hex())
+        self.assertEqual(response.json()['prev_block'], self.blocks[0].hash().hex())
+        self.assertEqual(self.client.get('/blocks/13/').status_code, 404)
+
+    def test_etag(self):
+        response = self.client.get('/blocks/1/')
+        etag = response['ETag']
+        # Block 1 is final, block 12 isn't.
+        self.assertIn('max-age={}'.format(FINAL_TIMEOUT), response['Cache-Control'])
+        self.assertIn('max-age={}'.format(RECENT_TIMEOUT), self.client.get('/blocks/12/')['Cache-Control'])
+        self.assertEqual(self.client.get('/blocks/1/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Rolled back blocks are dropped from the cache.
+        self.client.get('/blocks/12/')
+        rollback(11)
+        self.assertEqual(self.client.get('/blocks/12/').status_code, 404)
+
+    def test_cached_tx_is_updated_when_spent(self):
+        coinbase = self.blocks[0].txns[0]
+        url = '/transactions/{}/'.format(coinbase.hash().hex())
+        self.assertIsNone(self.client.get(url).json()['outputs'][0]['spent_by_tx'])
+        spend = make_spend([(coinbase.hash(), 0)], [4000])
+        writer = BlockWriter()
+        writer.add(make_block(self.blocks[-1].hash(), [make_coinbase(13), spend]), 13)
+        writer.flush()
+        self.assertEqual(self.client.get(url).json()['outputs'][0]['spent_by_tx'], spend.hash().hex())
+        tx = self.client.get('/transactions/{}/'.format(spend.hash().hex())).json()
+        self.assertEqual(tx['height'], 13)
+        self.assertEqual(tx['inputs'][0]['spent_output'], {'address': SCRIPT_X.address(), 'amount': 5000})
+
+    def test_transactions_of_block(self):
+        response = self.client.get('/transactions/?block=3')
+        self.assertEqual([tx['tx_id'] for tx in response.json()['results']], [self.blocks[2].txns[0].hash().hex()])
+
+    def test_inputs_and_outputs(self):
+        coinbase = self.blocks[0].txns[0]
+        spend = make_spend([(coinbase.hash(), 0)], [3000, 1900])
+        writer = BlockWriter()
+        writer.add(make_block(self.blocks[-1].hash(), [make_coinbase(13), spend]), 13)
+        writer.flush()
+        response = self.client.get('/outputs/?tx={}'.format(spend.hash().hex()))
+        outputs = response.json()['results']
+        self.assertEqual([(output['tx_id'], output['index'], output['amount']) for output in outputs],
+                         [(spend.hash().hex(), 0, 3000), (spend.hash().hex(), 1, 1900)])
+        response = self.client.get('/inputs/?tx={}'.format(spend.hash().hex()))
+        tx_input = response.json()['results'][0]
+        self.assertEqual(tx_input['spent_output'], {'address': SCRIPT_X.address(), 'amount': 5000})
+        self.assertEqual(self.client.get('/inputs/{}/'.format(tx_input['pk_id'])).json(), tx_input)
+        output = self.client.get('/outputs/?tx={}'.format(coinbase.hash().hex())).json()['results'][0]
+        self.assertEqual(output['spent_by_tx'], spend.hash().hex())
+        # Every output is listed without a txid, 10 by page.
+        response = self.client.get('/outputs/')
+        self.assertEqual(len(response.json()['results']), 10)
+        self.assertEqual(len(self.client.get(response.json()['next']).json()['results']), 5)
+
+
+class StatsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        # Two blocks on the first day, the second one with a tx paying a fee of 100, and one on the next day.
+        coinbase = make_coinbase(1)
+        spend = make_spend([(coinbase.hash(), 0)], [4900])
+        self.blocks = [make_block(b'\x00' * 32, [coinbase], timestamp=10)]
+        self.blocks.append(make_block(self.blocks[0].hash(), [make_coinbase(2), spend], timestamp=20))
+        self.blocks.append(make_block(self.blocks[1].hash(), [make_coinbase(3)], timestamp=DAY + 10))
+        writer = BlockWriter(batch_size=2)
+        for height, block in enumerate(self.blocks, start=1):
+            writer.add(block, height)
+        writer.flush()
+
+    def test_block_stats(self):
+        stats = BlockStats.objects.get(height=2)
+        self.assertEqual((stats.tx_count, stats.input_count, stats.output_count, stats.output_value, stats.fees),
+                         (2, 2, 2, 9900, 100))
+        self.assertEqual((stats.p2pkh_count, stats.nonstandard_count), (2, 0))
+
+    def test_daily_stats(self):
+        days = DailyStats.objects.order_by('day')
+        self.assertEqual([(day.day, day.blocks, day.tx_count, day.fees, day.p2pkh_count) for day in days],
+                         [(date(1970, 1, 1), 2, 3, 100, 3), (date(1970, 1, 2), 1, 1, 0, 1)])
+        response = self.client.get('/stats/days/1970-01-01/')
+        self.assertEqual(response.json()['output_value'], 14900)
+        response = self.client.get('/stats/blocks/?min_time={}'.format(DAY))
+        self.assertEqual([stats['height'] for stats in response.json()['results']], [3])
+
+    def test_rollback(self):
+        rollback(1)
+        self.assertEqual(list(BlockStats.objects.values_list('height', flat=True)), [1])
+        # The second day had no blocks left.
+        day = DailyStats.objects.get()
+        self.assertEqual((day.day, day.blocks, day.tx_count, day.fees, day.output_value),
+                         (date(1970, 1, 1), 1, 1, 0, 5000))
+
+
+class ExportTest(TransactionTestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.out_dir)
+        self.blocks = write_chain(5)
+
+    def export(self, *args):
+        call_command('export', self.out_dir, '--range-size', '2', '--workers', '2', *args, stdout=StringIO())
+
+    def read(self, name):
+        with gzip.open(os.path.join(self.out_dir, name), 'rt', newline='') as f:
+            return list(csv.reader(f))
+
+    def test_export(self):
+        self.export()
+        self.assertEqual(sorted(os.listdir(self.out_dir)), sorted(
+            '{}-{:09d}-{:09d}.csv.gz'.format(table, start, end)
+            for table in ['blocks', 'transactions', 'inputs', 'outputs'] for start, end in [(0, 1), (2, 3), (4, 5)]))
+        rows = self.read('blocks-000000002-000000003.csv.gz')
+        self.assertEqual(rows[0][:2], ['height', 'hash_id'])
+        self.assertEqual([row[:2] for row in rows[1:]], [
+            ['2', self.blocks[1].hash().hex()], ['3', self.blocks[2].hash().hex()]])
+        rows = self.read('outputs-000000004-000000005.csv.gz')
+        self.assertEqual([row[0] for row in rows[1:]], [block.txns[0].hash().hex() for block in self.blocks[3:]])
+
+    def test_resume(self):
+        # A range that isn't aligned is exported whole, so a later run finds its files.
+        self.export('--from-height', '3', '--to-height', '3')
+        self.assertIn('blocks-000000002-000000003.csv.gz', os.listdir(self.out_dir))
+        path = os.path.join(self.out_dir, 'blocks-000000002-000000003.csv.gz')
+        modified = os.path.getmtime(path)
+        os.utime(path, (modified - 100, modified - 100))
+        self.export()
+        # The range that was already exported is skipped.
+        self.assertEqual(os.path.getmtime(path), modified - 100)
+        self.assertEqual(len(os.listdir(self.out_dir)), 12)
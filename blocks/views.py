@@ -1,11 +1,228 @@
-from .models import BlockRow
-from rest_framework import viewsets
-from .serializers import BlockSerializer
+from django.db.models import Prefetch
+from django.http import Http404
+from django.utils.dateparse import parse_date
+from .caching import (
+    FINAL_TIMEOUT, RECENT_TIMEOUT, TX_TIMEOUT, block_key, cached_response, forget_blocks_above, is_final, tx_key)
+from .models import Address, AddressTransaction, BlockRow, BlockStats, DailyStats, Transaction, TxInput, TxOutput
+from rest_framework import filters, viewsets
+from rest_framework.decorators import action
+from .pagination import (
+    AddressCursorPagination, AddressHistoryCursorPagination, BlockCursorPagination, DayCursorPagination,
+    TransactionCursorPagination)
+from .serializers import (
+    AddressSerializer, AddressTransactionSerializer, BlockListSerializer, BlockSerializer, BlockStatsSerializer,
+    DailyStatsSerializer, TransactionSerializer, TxInputDetailSerializer, TxOutputDetailSerializer)
 
 
 class BlockViewSet(viewsets.ModelViewSet):
     """
-    API endpoint that allows users to be viewed or edited.
+    API endpoint that allows blocks to be viewed or edited.
+
+    Blocks are addressed by height: /blocks/<height>/. A range of heights can be asked for with
+    ?min_height=&max_height=, and ?ordering=-height lists the latest blocks first. Lists are paginated with
+    a cursor (follow the next and previous links). Single blocks are cached, for a long time once they
+    are final (see caching.py).
+    """
+    queryset = BlockRow.objects.all().order_by('height')
+    serializer_class = BlockSerializer
+    lookup_field = 'height'
+    lookup_value_regex = '[0-9]+'
+    filter_backends = [filters.OrderingFilter]
+    ordering_fields = ['height']
+    ordering = ['height']
+    pagination_class = BlockCursorPagination
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return BlockListSerializer
+        return BlockSerializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # Both ends of the range are inclusive. Bad values are ignored.
+        min_height = self.request.query_params.get('min_height')
+        if min_height is not None and min_height.isdigit():
+            queryset = queryset.filter(height__gte=int(min_height))
+        max_height = self.request.query_params.get('max_height')
+        if max_height is not None and max_height.isdigit():
+            queryset = queryset.filter(height__lte=int(max_height))
+        if self.action == 'list':
+            queryset = queryset.values(*BlockListSerializer.FIELDS)
+        return queryset
+
+    def retrieve(self, request, *args, **kwargs):
+        height = int(kwargs['height'])
+
+        def load():
+            data = self.get_serializer(self.get_object()).data
+            timeout = FINAL_TIMEOUT if is_final(height) else RECENT_TIMEOUT
+            return data, timeout, timeout
+        return cached_response(request, block_key(height), load)
+
+    # Edited and deleted blocks are dropped from the cache.
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        forget_blocks_above(serializer.instance.height - 1)
+
+    def perform_destroy(self, instance):
+        forget_blocks_above(instance.height - 1)
+        super().perform_destroy(instance)
+
+
+class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint with transactions, their inputs and their outputs. Transactions are addressed by id:
+    /transactions/<txid>/, and the transactions of a block are listed with ?block=<height>, in the order
+    they are in the block.
+    """
+    # Inputs and outputs (and what they spend or are spent by) are loaded with one query each for the
+    # whole page, so the number of queries doesn't depend on the number of txs.
+    queryset = Transaction.objects.select_related('block').prefetch_related(
+        Prefetch('txinput_set', queryset=TxInput.objects.order_by('pk_id').prefetch_related('spent_outputs')),
+        Prefetch('txoutput_set', queryset=TxOutput.objects.order_by('index').select_related('spent_by__transaction')),
+    )
+    serializer_class = TransactionSerializer
+    pagination_class = TransactionCursorPagination
+    lookup_field = 'hash_id'
+    lookup_value_regex = '[0-9a-fA-F]{64}'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        block = self.request.query_params.get('block')
+        if block is not None and block.isdigit():
+            queryset = queryset.filter(block__height=int(block))
+        return queryset
+
+    def get_object(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        # The same txid can appear twice (two early coinbase txs do); the first one is shown.
+        transaction = queryset.filter(hash_id=bytes.fromhex(self.kwargs['hash_id'])).order_by('pk_id').first()
+        if transaction is None:
+            raise Http404
+        self.check_object_permissions(self.request, transaction)
+        return transaction
+
+    def retrieve(self, request, *args, **kwargs):
+        tx_id = kwargs['hash_id'].lower()
+
+        def load():
+            return self.get_serializer(self.get_object()).data, TX_TIMEOUT, RECENT_TIMEOUT
+        return cached_response(request, tx_key(tx_id), load)
+
+
+# Filters inputs or outputs by the txid given with ?tx=, which goes through the index on the tx hash.
+# Bad values are ignored.
+def filter_by_tx(request, queryset):
+    tx_id = request.query_params.get('tx')
+    if tx_id is None or len(tx_id) != 64:
+        return queryset
+    try:
+        return queryset.filter(transaction__hash_id=bytes.fromhex(tx_id))
+    except ValueError:
+        return queryset
+
+
+class TxInputViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint with transaction inputs: /inputs/<id>/. The inputs of a transaction are listed with
+    ?tx=<txid>, in the order they are in the transaction.
+    """
+    queryset = TxInput.objects.select_related('transaction').prefetch_related('spent_outputs')
+    serializer_class = TxInputDetailSerializer
+    pagination_class = TransactionCursorPagination
+    lookup_value_regex = '[0-9]+'
+
+    def get_queryset(self):
+        return filter_by_tx(self.request, super().get_queryset())
+
+
+class TxOutputViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint with transaction outputs: /outputs/<id>/. The outputs of a transaction are listed with
+    ?tx=<txid>, in the order they are in the transaction.
+    """
+    queryset = TxOutput.objects.select_related('transaction', 'spent_by__transaction')
+    serializer_class = TxOutputDetailSerializer
+    pagination_class = TransactionCursorPagination
+    lookup_value_regex = '[0-9]+'
+
+    def get_queryset(self):
+        return filter_by_tx(self.request, super().get_queryset())
+
+
+class AddressViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint with the balance and totals of an address: /addresses/<address>/, and its transactions,
+    latest first: /addresses/<address>/history/.
     """
-    queryset = BlockRow.objects.all().order_by('pk_id')
-    serializer_class = BlockSerializer
\ No newline at end of file
+    queryset = Address.objects.all()
+    serializer_class = AddressSerializer
+    lookup_field = 'address'
+    pagination_class = AddressCursorPagination
+
+    @action(detail=True)
+    def history(self, request, address=None):
+        address_row = self.get_object()
+        queryset = AddressTransaction.objects.filter(address=address_row).select_related('transaction')
+        paginator = AddressHistoryCursorPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = AddressTransactionSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+# Returns the date value of a query param, or None if it's missing or not a valid date.
+def parse_date_param(value):
+    try:
+        return parse_date(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+# Returns the int value of a query param, or None if it's missing or not a number.
+def int_param(request, name):
+    value = request.query_params.get(name)
+    if value is None or not value.isdigit():
+        return None
+    return int(value)
+
+
+class BlockStatsViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint with the totals of each block: /stats/blocks/<height>/. Ranges can be asked for by height
+    with ?min_height=&max_height=, or by block timestamp with ?min_time=&max_time= (both inclusive).
+    """
+    queryset = BlockStats.objects.all()
+    serializer_class = BlockStatsSerializer
+    pagination_class = BlockCursorPagination
+    lookup_field = 'height'
+    lookup_value_regex = '[0-9]+'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        for param, lookup in [('min_height', 'height__gte'), ('max_height', 'height__lte'),
+                              ('min_time', 'timestamp__gte'), ('max_time', 'timestamp__lte')]:
+            value = int_param(self.request, param)
+            if value is not None:
+                queryset = queryset.filter(**{lookup: value})
+        return queryset
+
+
+class DailyStatsViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint with the totals of each day (UTC): /stats/days/<YYYY-MM-DD>/. A range of days can be asked
+    for with ?since=&until= (both inclusive, YYYY-MM-DD).
+    """
+    queryset = DailyStats.objects.all()
+    serializer_class = DailyStatsSerializer
+    pagination_class = DayCursorPagination
+    lookup_field = 'day'
+    lookup_value_regex = '[0-9]{4}-[0-9]{2}-[0-9]{2}'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # Bad dates are ignored.
+        for param, lookup in [('since', 'day__gte'), ('until', 'day__lte')]:
+            value = parse_date_param(self.request.query_params.get(param))
+            if value is not None:
+                queryset = queryset.filter(**{lookup: value})
+        return queryset
@@ -16,10 +16,18 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 from rest_framework import routers
-from blocks.views import BlockViewSet
+from blocks.views import (
+    AddressViewSet, BlockStatsViewSet, BlockViewSet, DailyStatsViewSet, TransactionViewSet, TxInputViewSet,
+    TxOutputViewSet)
 
 router = routers.DefaultRouter()
 router.register(r'blocks', BlockViewSet)
+router.register(r'transactions', TransactionViewSet)
+router.register(r'inputs', TxInputViewSet)
+router.register(r'outputs', TxOutputViewSet)
+router.register(r'addresses', AddressViewSet)
+router.register(r'stats/blocks', BlockStatsViewSet)
+router.register(r'stats/days', DailyStatsViewSet)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
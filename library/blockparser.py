@@ -0,0 +1,352 @@
+import gc
+import json
+import struct
+
+from io import BytesIO
+from unittest import TestCase
+
+from .block import GENESIS_BLOCK
+from .helper import hash256
+from .network import BlockMessage
+from .script import Script
+from .tx import Tx, TxIn, TxOut
+
+# Parsers that walk a serialized block with an integer offset, instead of reading every field from a
+# BytesIO stream. Fixed size integers are unpacked in place with struct, so the only copies made are the
+# bytes the objects keep (hashes, script elements and witness items). Each function receives the buffer
+# and the offset where the object starts, and returns the parsed object and the offset right after it.
+# The objects are the same ones the stream parsers return (BlockMessage, Tx, TxIn, TxOut and Script).
+
+unpack_uint16 = struct.Struct('<H').unpack_from
+unpack_uint32 = struct.Struct('<I').unpack_from
+unpack_uint64 = struct.Struct('<Q').unpack_from
+
+
+# Reads a varint (variable integer) at the given offset - page 92.
+def read_varint_at(buf, offset):
+    i = buf[offset]
+    # if i is less than 0xfd, the number is i
+    if i < 0xfd:
+        return i, offset + 1
+    # if i is 0xfd, next two bytes are the number
+    elif i == 0xfd:
+        return unpack_uint16(buf, offset + 1)[0], offset + 3
+    # if i is 0xfe, next 4 bytes are the number
+    elif i == 0xfe:
+        return unpack_uint32(buf, offset + 1)[0], offset + 5
+    # if i is 0xff, next 8 bytes are the number
+    else:
+        return unpack_uint64(buf, offset + 1)[0], offset + 9
+
+
+# Same as Script.parse, over a buffer.
+def parse_script_at(buf, offset, coinbase=False):
+    length, offset = read_varint_at(buf, offset)
+    end = offset + length
+    cmds = []
+    # parse until whole script has been parsed.
+    while offset < end:
+        # this byte's value determines if we have an opcode or an element.
+        current = buf[offset]
+        offset += 1
+        # for a number between 1 and 75, we know the next n bytes are an element.
+        if 1 <= current <= 75:
+            n = current
+        # 76 is OP_PUSHDATA1, so the next byte tells us how many bytes the next element is.
+        elif current == 76:
+            n = buf[offset]
+            offset += 1
+        # 77 is OP_PUSHDATA2, so the next 2 bytes tell us how many bytes the next element is.
+        elif current == 77:
+            n = unpack_uint16(buf, offset)[0]
+            offset += 2
+        # else we push the opcode onto the stack
+        else:
+            cmds.append(current)
+            continue
+        # if tx is coinbase, ScriptSig can be whatever so we read until the end of the script.
+        if offset + n > end and coinbase:
+            n = end - offset
+        cmds.append(buf[offset:offset + n])
+        offset += n
+    # script should have consumed exactly the number of bytes expected. If not we raise an error.
+    if offset != end:
+        raise SyntaxError('Parsing script failed.')
+    return Script(cmds), offset
+
+
+# TxIn that keeps where its ScriptSig is in the block instead of parsing it. The ScriptSig is parsed
+# the first time it's accessed, and serializing the input just copies the original bytes.
+class LazyTxIn(TxIn):
+
+    def __init__(self, prev_tx, prev_index, buf, script_start, script_end, sequence, coinbase=False):
+        self.buf = buf
+        # Where the serialized ScriptSig (with its length) starts and ends in buf.
+        self.script_start = script_start
+        self.script_end = script_end
+        self.coinbase = coinbase
+        self._script_sig = None
+        super().__init__(prev_tx, prev_index, None, sequence)
+
+    @property
+    def script_sig(self):
+        if self._script_sig is None and self.buf is not None:
+            self._script_sig = parse_script_at(self.buf, self.script_start, self.coinbase)[0]
+        return self._script_sig
+
+    # Setting a new ScriptSig (e.g. when signing) means the original bytes don't apply anymore.
+    @script_sig.setter
+    def script_sig(self, script_sig):
+        if script_sig is not None:
+            self.buf = None
+        self._script_sig = script_sig
+
+    def serialize_script_sig(self):
+        if self.buf is None:
+            return super().serialize_script_sig()
+        return self.buf[self.script_start:self.script_end]
+
+
+# TxOut that keeps where its ScriptPubKey is in the block instead of parsing it. The ScriptPubKey is
+# parsed the first time it's accessed, and serializing the output just copies the original bytes.
+class LazyTxOut(TxOut):
+
+    def __init__(self, amount, buf, script_start, script_end):
+        self.buf = buf
+        # Where the serialized ScriptPubKey (with its length) starts and ends in buf.
+        self.script_start = script_start
+        self.script_end = script_end
+        self._script_pubkey = None
+        super().__init__(amount, None)
+
+    @property
+    def script_pubkey(self):
+        if self._script_pubkey is None and self.buf is not None:
+            self._script_pubkey = parse_script_at(self.buf, self.script_start)[0]
+        return self._script_pubkey
+
+    @script_pubkey.setter
+    def script_pubkey(self, script_pubkey):
+        if script_pubkey is not None:
+            self.buf = None
+        self._script_pubkey = script_pubkey
+
+    def serialize_script_pubkey(self):
+        if self.buf is None:
+            return super().serialize_script_pubkey()
+        return self.buf[self.script_start:self.script_end]
+
+
+# Returns the offset right after the serialized script that starts at the given offset.
+def skip_script_at(buf, offset):
+    length, script_offset = read_varint_at(buf, offset)
+    return script_offset + length
+
+
+# Same as TxIn.parse, over a buffer.
+def parse_tx_in_at(buf, offset):
+    # prev_tx is 32 bytes, little endian, interpreted as bytes.
+    prev_tx = buf[offset:offset + 32][::-1]
+    # prev_index is 4 bytes, little endian, interpreted as integer.
+    prev_index = unpack_uint32(buf, offset + 32)[0]
+    # Flag to let the script parser know if this is a coinbase input.
+    coinbase = prev_index == 0xffffffff and prev_tx == b'\x00' * 32
+    script_sig, offset = parse_script_at(buf, offset + 36, coinbase)
+    sequence = unpack_uint32(buf, offset)[0]
+    return TxIn(prev_tx, prev_index, script_sig, sequence), offset + 4
+
+
+# Same as TxOut.parse, over a buffer.
+def parse_tx_out_at(buf, offset):
+    amount = unpack_uint64(buf, offset)[0]
+    script_pubkey, offset = parse_script_at(buf, offset + 8)
+    return TxOut(amount, script_pubkey), offset
+
+
+# Same as parse_tx_in_at, but returns a LazyTxIn.
+def parse_lazy_tx_in_at(buf, offset):
+    prev_tx = buf[offset:offset + 32][::-1]
+    prev_index = unpack_uint32(buf, offset + 32)[0]
+    coinbase = prev_index == 0xffffffff and prev_tx == b'\x00' * 32
+    script_start = offset + 36
+    script_end = skip_script_at(buf, script_start)
+    sequence = unpack_uint32(buf, script_end)[0]
+    return LazyTxIn(prev_tx, prev_index, buf, script_start, script_end, sequence, coinbase), script_end + 4
+
+
+# Same as parse_tx_out_at, but returns a LazyTxOut.
+def parse_lazy_tx_out_at(buf, offset):
+    amount = unpack_uint64(buf, offset)[0]
+    script_end = skip_script_at(buf, offset + 8)
+    return LazyTxOut(amount, buf, offset + 8, script_end), script_end
+
+
+# Same as Tx.parse, over a buffer. Handles both legacy and segwit transactions.
+# If lazy is True, inputs and outputs are LazyTxIn and LazyTxOut objects.
+def parse_tx_at(buf, offset, testnet=False, lazy=False):
+    if lazy:
+        parse_in, parse_out = parse_lazy_tx_in_at, parse_lazy_tx_out_at
+    else:
+        parse_in, parse_out = parse_tx_in_at, parse_tx_out_at
+    start = offset
+    version = unpack_uint32(buf, offset)[0]
+    offset += 4
+    # if, after version, we have a 0 byte (the segwit marker), the transaction is segwit - page 231.
+    segwit = buf[offset] == 0
+    if segwit:
+        # For transaction to be segwit, marker and flag need to be b'\x00\x01'.
+        if buf[offset + 1] != 1:
+            raise RuntimeError('Not a segwit transaction {}'.format(buf[offset:offset + 2]))
+        offset += 2
+    num_inputs, offset = read_varint_at(buf, offset)
+    inputs = []
+    for _ in range(num_inputs):
+        tx_in, offset = parse_in(buf, offset)
+        inputs.append(tx_in)
+    num_outputs, offset = read_varint_at(buf, offset)
+    outputs = []
+    for _ in range(num_outputs):
+        tx_out, offset = parse_out(buf, offset)
+        outputs.append(tx_out)
+    witness_start = offset
+    if segwit:
+        # Each input has a list of witness items.
+        for tx_in in inputs:
+            num_items, offset = read_varint_at(buf, offset)
+            items = []
+            for _ in range(num_items):
+                item_len, offset = read_varint_at(buf, offset)
+                if item_len == 0:
+                    items.append(0)
+                else:
+                    items.append(buf[offset:offset + item_len])
+                    offset += item_len
+            tx_in.witness = items
+    locktime = unpack_uint32(buf, offset)[0]
+    txn = Tx(version, inputs, outputs, locktime, testnet=testnet, segwit=segwit)
+    end = offset + 4
+    # We hash the bytes we just parsed instead of serializing the tx again later. The txid doesn't include
+    # the segwit marker, flag and witness, so for segwit txs we join the parts around them.
+    raw = buf[start:end]
+    if segwit:
+        txn._witness_hash = hash256(raw)[::-1]
+        txn._hash = hash256(buf[start:start + 4] + buf[start + 6:witness_start] + buf[offset:end])[::-1]
+    else:
+        txn._hash = txn._witness_hash = hash256(raw)[::-1]
+    return txn, end
+
+
+# Same as BlockMessage.parse, but receives the whole serialized block (e.g. the payload of a block
+# message) and walks it with an offset. With lazy=True scripts are only parsed when accessed, which is
+# what the indexer wants, as it mostly stores the scripts' bytes.
+def parse_block(payload, testnet=False, lazy=False):
+    # Slices of the buffer become the bytes elements of scripts, so they need to be bytes objects.
+    if type(payload) is not bytes:
+        payload = bytes(payload)
+    buf = payload
+    # A block creates hundreds of thousands of objects without reference cycles, so the garbage
+    # collector would only waste time going over them while we parse.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        version = unpack_uint32(buf, 0)[0]
+        prev_block = buf[4:36][::-1]
+        merkle_root = buf[36:68][::-1]
+        timestamp = unpack_uint32(buf, 68)[0]
+        bits = buf[72:76]
+        nonce = buf[76:80]
+        txn_count, offset = read_varint_at(buf, 80)
+        txns = []
+        for _ in range(txn_count):
+            txn, offset = parse_tx_at(buf, offset, testnet, lazy)
+            txns.append(txn)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    block = BlockMessage(version, prev_block, merkle_root, timestamp, bits, nonce, txn_count, txns)
+    block.raw = payload
+    return block
+
+
+class BlockParserTest(TestCase):
+
+    coinbase_tx = '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000'
+    legacy_tx = '0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600'
+    cache_file = './tx.cache'
+
+    # Returns the serialization of a block with a coinbase, a legacy and every segwit tx of the cache.
+    def raw_block(self):
+        with open(self.cache_file, 'r') as f:
+            cache = json.loads(f.read())
+        segwit_txs = [raw_hex for raw_hex in cache.values() if raw_hex[8:12] == '0001']
+        txs = [bytes.fromhex(raw_hex) for raw_hex in [self.coinbase_tx, self.legacy_tx] + segwit_txs]
+        return GENESIS_BLOCK + bytes([len(txs)]) + b''.join(txs)
+
+    def test_read_varint_at(self):
+        buf = bytes.fromhex('ff0100000000000000fd0102fe01020304aa')
+        self.assertEqual(read_varint_at(buf, 0), (1, 9))
+        self.assertEqual(read_varint_at(buf, 9), (0x0201, 12))
+        self.assertEqual(read_varint_at(buf, 12), (0x04030201, 17))
+        self.assertEqual(read_varint_at(buf, 17), (0xaa, 18))
+
+    def test_parse_block(self):
+        raw = self.raw_block()
+        want = BlockMessage.parse(BytesIO(raw))
+        block = parse_block(memoryview(raw))
+        self.assertEqual(block.hash(), want.hash())
+        self.assertEqual(block.txn_count, want.txn_count)
+        self.assertEqual(block.serialize(), raw)
+        self.assertEqual(block.raw, raw)
+        for txn, want_txn in zip(block.txns, want.txns):
+            self.assertEqual(txn.segwit, want_txn.segwit)
+            self.assertEqual(txn.id(), want_txn.id())
+            for tx_in, want_in in zip(txn.tx_inputs, want_txn.tx_inputs):
+                self.assertEqual(tx_in.script_sig.cmds, want_in.script_sig.cmds)
+                self.assertEqual(getattr(tx_in, 'witness', None), getattr(want_in, 'witness', None))
+            for tx_out, want_out in zip(txn.tx_outputs, want_txn.tx_outputs):
+                self.assertEqual(tx_out.amount, want_out.amount)
+                self.assertEqual(tx_out.script_pubkey.cmds, want_out.script_pubkey.cmds)
+
+    def test_parse_tx_at(self):
+        raw = bytes.fromhex(self.legacy_tx)
+        txn, offset = parse_tx_at(raw, 0)
+        self.assertEqual(offset, len(raw))
+        self.assertEqual(txn.serialize(), raw)
+        self.assertEqual(txn.locktime, 410393)
+
+    def test_tx_hashes(self):
+        # The cache is keyed by txid, and has both legacy and segwit transactions.
+        with open(self.cache_file, 'r') as f:
+            cache = json.loads(f.read())
+        for tx_id, raw_hex in cache.items():
+            raw = bytes.fromhex(raw_hex)
+            txn, _ = parse_tx_at(raw, 0)
+            self.assertEqual(txn.id(), tx_id)
+            self.assertEqual(txn.witness_hash(), hash256(raw)[::-1])
+
+    def test_parse_block_lazy(self):
+        raw = self.raw_block()
+        want = parse_block(raw)
+        block = parse_block(raw, lazy=True)
+        self.assertEqual(block.serialize(), raw)
+        tx_in = block.txns[1].tx_inputs[0]
+        self.assertIsInstance(tx_in, LazyTxIn)
+        # Nothing is parsed until we access the script.
+        self.assertIsNone(tx_in._script_sig)
+        self.assertEqual(tx_in.serialize_script_sig(), want.txns[1].tx_inputs[0].script_sig.serialize())
+        self.assertIsNone(tx_in._script_sig)
+        self.assertEqual(tx_in.script_sig.cmds, want.txns[1].tx_inputs[0].script_sig.cmds)
+        coinbase_in = block.txns[0].tx_inputs[0]
+        self.assertEqual(coinbase_in.script_sig.cmds, want.txns[0].tx_inputs[0].script_sig.cmds)
+        for txn, want_txn in zip(block.txns, want.txns):
+            self.assertEqual(txn.id(), want_txn.id())
+            for tx_out, want_out in zip(txn.tx_outputs, want_txn.tx_outputs):
+                self.assertEqual(tx_out.script_pubkey.cmds, want_out.script_pubkey.cmds)
+
+    def test_lazy_set_script(self):
+        raw = bytes.fromhex(self.legacy_tx)
+        txn, _ = parse_tx_at(raw, 0, lazy=True)
+        txn.tx_inputs[0].script_sig = Script([b'\x01'])
+        self.assertEqual(txn.tx_inputs[0].serialize_script_sig(), bytes.fromhex('020101'))
+        txn.tx_outputs[0].script_pubkey = Script([0x6a])
+        self.assertEqual(txn.tx_outputs[0].serialize_script_pubkey(), bytes.fromhex('016a'))
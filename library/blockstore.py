@@ -0,0 +1,170 @@
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+
+from unittest import TestCase
+
+from .network import NETWORK_MAGIC, TESTNET_NETWORK_MAGIC
+
+# Blocks are appended to numbered files (blk00000.dat, blk00001.dat, ...) like bitcoind does: each one is
+# the network magic, its length (4 bytes little endian) and the serialized block. Where each block is,
+# by height and hash, is kept in a sqlite index in the same directory.
+RECORD_HEADER = struct.Struct('<4sI')
+INDEX_FILE = 'index.sqlite'
+
+
+# Append-only store of the raw blocks of the chain, read back with mmap. Like UtxoSet, blocks are added
+# in height order, and the index rows of the blocks added since the last flush are only kept in memory.
+class BlockStore:
+
+    def __init__(self, directory, max_file_size=128 * 1024 * 1024, testnet=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.magic = TESTNET_NETWORK_MAGIC if testnet else NETWORK_MAGIC
+        self.db = sqlite3.connect(os.path.join(directory, INDEX_FILE))
+        self.db.execute('CREATE TABLE IF NOT EXISTS blocks (height INTEGER PRIMARY KEY, hash BLOB NOT NULL, '
+                        'file INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS blocks_hash ON blocks (hash)')
+        self.db.commit()
+        # Index rows not written yet, by height: (hash, file, offset, length).
+        self.pending = {}
+        # Memory maps of the files, by number.
+        self.maps = {}
+        row = self.db.execute('SELECT MAX(height), MAX(file) FROM blocks').fetchone()
+        # Height of the last block added, 0 if there are none.
+        self.height = row[0] or 0
+        # Blocks are appended to the last file. Blocks written after the last flush are orphaned.
+        self.file_number = row[1] or 0
+        self.file = open(self.path(self.file_number), 'ab')
+
+    def __repr__(self):
+        return 'block store height: {}'.format(self.height)
+
+    def path(self, file_number):
+        return os.path.join(self.directory, 'blk{:05d}.dat'.format(file_number))
+
+    # Adds the serialized block at the given height, which must come right after the last one.
+    def add(self, height, block_hash, raw_block):
+        if height != self.height + 1:
+            raise ValueError('Block {} does not follow the block store tip at height {}.'.format(height, self.height))
+        record_size = RECORD_HEADER.size + len(raw_block)
+        if self.file.tell() > 0 and self.file.tell() + record_size > self.max_file_size:
+            self.file.close()
+            self.file_number += 1
+            self.file = open(self.path(self.file_number), 'ab')
+        offset = self.file.tell() + RECORD_HEADER.size
+        self.file.write(RECORD_HEADER.pack(self.magic, len(raw_block)) + raw_block)
+        self.pending[height] = (block_hash, self.file_number, offset, len(raw_block))
+        self.height = height
+
+    def location(self, height):
+        if height in self.pending:
+            return self.pending[height][1:]
+        return self.db.execute('SELECT file, offset, length FROM blocks WHERE height = ?', (height,)).fetchone()
+
+    def read(self, file_number, offset, length):
+        if file_number == self.file_number:
+            self.file.flush()
+        block_map = self.maps.get(file_number)
+        # Blocks appended after the file was mapped need a new map.
+        if block_map is None or offset + length > len(block_map):
+            if block_map is not None:
+                block_map.close()
+            with open(self.path(file_number), 'rb') as f:
+                block_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[file_number] = block_map
+        return block_map[offset:offset + length]
+
+    # Returns the serialized block at the given height, or None if it's not in the store.
+    def get(self, height):
+        location = self.location(height)
+        if location is None:
+            return None
+        return self.read(*location)
+
+    # Returns the height of the block with the given hash, or None if it's not in the store.
+    def height_of(self, block_hash):
+        for height, (pending_hash, _, _, _) in self.pending.items():
+            if pending_hash == block_hash:
+                return height
+        row = self.db.execute('SELECT height FROM blocks WHERE hash = ?', (block_hash,)).fetchone()
+        return row[0] if row is not None else None
+
+    # Returns an iterator of (height, serialized block) for the blocks from start to end (inclusive), in
+    # height order. The index is queried right away, so the iterator can be consumed from another thread.
+    def blocks(self, start=1, end=None):
+        self.flush()
+        end = self.height if end is None else end
+        rows = self.db.execute('SELECT height, file, offset, length FROM blocks WHERE height >= ? AND height <= ? '
+                               'ORDER BY height', (start, end)).fetchall()
+        return ((height, self.read(file_number, offset, length)) for height, file_number, offset, length in rows)
+
+    # Forgets the blocks above the given height, e.g. after a reorg. Their bytes stay in the files.
+    def rewind(self, height):
+        for pending_height in list(self.pending):
+            if pending_height > height:
+                del self.pending[pending_height]
+        with self.db:
+            self.db.execute('DELETE FROM blocks WHERE height > ?', (height,))
+        self.height = min(self.height, height)
+
+    # Writes the blocks to disk before their index rows, so the index never points past the end of a file.
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO blocks (height, hash, file, offset, length) VALUES (?, ?, ?, ?, ?)',
+                                ((height,) + row for height, row in self.pending.items()))
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        for block_map in self.maps.values():
+            block_map.close()
+        self.maps = {}
+        self.db.close()
+
+
+class BlockStoreTest(TestCase):
+
+    def test_add_and_get(self):
+        directory = tempfile.mkdtemp()
+        store = BlockStore(directory, max_file_size=100)
+        raw_blocks = [bytes([i]) * 40 for i in range(1, 6)]
+        for height, raw_block in enumerate(raw_blocks, start=1):
+            store.add(height, bytes([height]) * 32, raw_block)
+        self.assertEqual(store.get(2), raw_blocks[1])
+        store.flush()
+        with self.assertRaises(ValueError):
+            store.add(7, b'\x07' * 32, b'')
+        store.close()
+        store = BlockStore(directory, max_file_size=100)
+        self.assertEqual(store.height, 5)
+        # Two blocks fit in each file.
+        self.assertEqual(store.file_number, 2)
+        self.assertEqual(store.height_of(b'\x04' * 32), 4)
+        self.assertEqual([raw for _, raw in store.blocks(2, 4)], raw_blocks[1:4])
+        self.assertIsNone(store.get(6))
+        store.close()
+
+    def test_rewind(self):
+        directory = tempfile.mkdtemp()
+        store = BlockStore(directory)
+        for height in range(1, 4):
+            store.add(height, bytes([height]) * 32, bytes([height]) * 10)
+        store.flush()
+        store.add(4, b'\x04' * 32, b'\x04' * 10)
+        store.rewind(2)
+        self.assertIsNone(store.get(3))
+        self.assertIsNone(store.height_of(b'\x04' * 32))
+        store.add(3, b'\x33' * 32, b'\x33' * 10)
+        store.close()
+        store = BlockStore(directory)
+        self.assertEqual(store.height, 3)
+        self.assertEqual(store.get(3), b'\x33' * 10)
+        self.assertEqual(list(store.blocks()), [(1, b'\x01' * 10), (2, b'\x02' * 10), (3, b'\x33' * 10)])
+        store.close()
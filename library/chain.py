@@ -0,0 +1,424 @@
+import os
+
+from io import BytesIO
+from unittest import TestCase
+
+from .block import Block, GENESIS_BLOCK, TESTNET_GENESIS_BLOCK
+from .helper import bits_to_target, calculate_new_bits
+from .network import GetHeadersMessage, HeadersMessage
+
+# Difficulty is adjusted every 2016 blocks - page 174.
+RETARGET_INTERVAL = 2016
+# Max. number of headers a node sends in a headers message.
+MAX_HEADERS = 2000
+# Size of a serialized block header.
+HEADER_SIZE = 80
+
+
+# Returns the hash of the genesis block, which is the starting point of any chain.
+def genesis_hash(testnet=False):
+    if testnet:
+        return Block.parse(BytesIO(TESTNET_GENESIS_BLOCK)).hash()
+    return Block.parse(BytesIO(GENESIS_BLOCK)).hash()
+
+
+# Returns the amount of work needed to find a block with the given bits: the expected number of
+# hashes to get one below the target. The valid chain is the one with the most total work.
+def block_work(bits):
+    return 2**256 // (bits_to_target(bits) + 1)
+
+
+# Keeps the hash and height of the last block of our chain in memory, so new headers can be
+# validated against it without asking the db for the last block every time.
+class ChainTip:
+
+    def __init__(self, tip_hash=None, height=0, testnet=False):
+        # If we don't have any block yet, the tip is the genesis block (height 0).
+        if tip_hash is None:
+            tip_hash = genesis_hash(testnet)
+        self.hash = tip_hash
+        self.height = height
+
+    def __repr__(self):
+        return 'tip: {} height: {}'.format(self.hash.hex(), self.height)
+
+    # Checks that the header comes right after the tip and has a valid PoW, then moves the tip to it.
+    # Returns the hash of the header.
+    def connect(self, header):
+        # We check that the received block comes after the previous block in the blockchain.
+        if header.prev_block != self.hash:
+            raise ValueError('Block is not the next one in the blockchain.')
+        if header.check_pow() is False:
+            raise ValueError('Bad PoW for current block.')
+        self.hash = header.hash()
+        self.height += 1
+        return self.hash
+
+    # Connects a list of headers (e.g. the blocks of a HeadersMessage) in order.
+    # Returns the list of their hashes.
+    def connect_headers(self, headers):
+        return [self.connect(header) for header in headers]
+
+
+# Keeps the whole chain of block headers in memory, validating each one when it's added. This lets us
+# download and validate every header first, and the blocks' bodies afterwards. Headers are kept as raw
+# bytes (80 bytes each) and, if a filename is given, appended to that file so they don't have to be
+# downloaded again on restart.
+class HeaderChain:
+
+    def __init__(self, filename=None, testnet=False):
+        self.testnet = testnet
+        if testnet:
+            genesis = TESTNET_GENESIS_BLOCK
+        else:
+            genesis = GENESIS_BLOCK
+        # Serialized headers, one after the other. Header at height h starts at byte h * 80.
+        self.raw = bytearray(genesis)
+        # Hash of the header at each height, and height of each hash.
+        self.hashes = [Block.parse(BytesIO(genesis)).hash()]
+        self.heights = {self.hashes[0]: 0}
+        # Total work of the chain up to each height.
+        self.work = [block_work(Block.parse(BytesIO(genesis)).bits)]
+        self.filename = filename
+        self.file = None
+        if filename is not None:
+            if os.path.exists(filename):
+                self.load(filename)
+            self.file = open(filename, 'ab')
+
+    def __repr__(self):
+        return 'header chain tip: {} height: {}'.format(self.tip().hex(), self.height())
+
+    # Height of the last header of the chain.
+    def height(self):
+        return len(self.hashes) - 1
+
+    # Hash of the last header of the chain.
+    def tip(self):
+        return self.hashes[-1]
+
+    # Returns the header at the given height as a Block object.
+    def header(self, height):
+        start = height * HEADER_SIZE
+        return Block.parse(BytesIO(self.raw[start:start + HEADER_SIZE]))
+
+    # Returns the hash of the header at the given height.
+    def hash_at(self, height):
+        return self.hashes[height]
+
+    # Returns the height of the header with the given hash, or None if it's not in the chain.
+    def height_of(self, block_hash):
+        return self.heights.get(block_hash)
+
+    # Returns the bits a header at the given height must have - page 175.
+    def expected_bits(self, height):
+        last_block = self.header(height - 1)
+        # Difficulty only changes at the beginning of each 2016 blocks period.
+        if height % RETARGET_INTERVAL != 0:
+            return last_block.bits
+        first_block = self.header(height - RETARGET_INTERVAL)
+        time_differential = last_block.timestamp - first_block.timestamp
+        return calculate_new_bits(last_block.bits, time_differential)
+
+    # Validates the header and adds it to the end of the chain in memory. Returns its hash.
+    def add(self, header):
+        height = len(self.hashes)
+        # We check that the received block comes after the previous block in the blockchain.
+        if header.prev_block != self.tip():
+            raise ValueError('Block is not the next one in the blockchain.')
+        if header.check_pow() is False:
+            raise ValueError('Bad PoW for current block.')
+        # Testnet allows minimum difficulty blocks, so we only check the difficulty on mainnet.
+        if not self.testnet and header.bits != self.expected_bits(height):
+            raise ValueError('Bad bits for block at height {}.'.format(height))
+        block_hash = header.hash()
+        self.raw += header.serialize()
+        self.hashes.append(block_hash)
+        self.heights[block_hash] = height
+        self.work.append(self.work[-1] + block_work(header.bits))
+        return block_hash
+
+    # Total work of the chain up to the given height (the tip by default).
+    def chain_work(self, height=None):
+        if height is None:
+            height = self.height()
+        return self.work[height]
+
+    # Returns the block locator of our chain: the hashes of the last 10 headers, then going back
+    # with steps that double each time, and finally the genesis block.
+    def locator(self):
+        hashes = []
+        step = 1
+        height = self.height()
+        while height > 0:
+            hashes.append(self.hashes[height])
+            if len(hashes) >= 10:
+                step *= 2
+            height -= step
+        hashes.append(self.hashes[0])
+        return hashes
+
+    # Removes every header after the given height from memory. Returns what was removed, so it can
+    # be put back with restore.
+    def truncate(self, height):
+        removed = (self.hashes[height + 1:], self.raw[(height + 1) * HEADER_SIZE:], self.work[height + 1:])
+        for block_hash in removed[0]:
+            del self.heights[block_hash]
+        del self.hashes[height + 1:]
+        del self.raw[(height + 1) * HEADER_SIZE:]
+        del self.work[height + 1:]
+        return removed
+
+    # Puts back the headers removed by truncate.
+    def restore(self, removed):
+        hashes, raw, work = removed
+        for block_hash in hashes:
+            self.heights[block_hash] = len(self.hashes)
+            self.hashes.append(block_hash)
+        self.raw += raw
+        self.work += work
+
+    # Removes every header after the given height, from memory and from the file.
+    def rewind(self, height):
+        self.truncate(height)
+        if self.file is not None:
+            # The genesis block is not saved in the file.
+            self.file.flush()
+            self.file.truncate(height * HEADER_SIZE)
+
+    # Validates and adds a list of headers (e.g. the blocks of a HeadersMessage) in order.
+    # If the first header doesn't come after our tip but after an older header of our chain, the node
+    # has a different branch from that point on. The branch replaces our headers after the fork point
+    # only if it has more work than ours, otherwise the headers are ignored.
+    # Returns the list of hashes of the headers added.
+    def add_headers(self, headers):
+        if len(headers) == 0:
+            return []
+        old_height = self.height()
+        old_work = self.chain_work()
+        fork_height = self.height_of(headers[0].prev_block)
+        if fork_height is None:
+            raise ValueError('Block is not the next one in the blockchain.')
+        removed = self.truncate(fork_height)
+        try:
+            hashes = [self.add(header) for header in headers]
+        except ValueError:
+            # An invalid branch leaves our chain as it was.
+            self.truncate(fork_height)
+            self.restore(removed)
+            raise
+        if fork_height < old_height and self.chain_work() <= old_work:
+            self.truncate(fork_height)
+            self.restore(removed)
+            return []
+        if self.file is not None:
+            if fork_height < old_height:
+                print('reorg: replacing {} headers after height {}'.format(old_height - fork_height, fork_height))
+                self.file.truncate(fork_height * HEADER_SIZE)
+            self.file.write(self.raw[(fork_height + 1) * HEADER_SIZE:])
+            self.file.flush()
+        return hashes
+
+    # Loads the headers saved in a file. They were validated before being saved, so we only check
+    # that each one points to the previous one.
+    def load(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        # An incomplete header at the end (e.g. if we crashed while writing it) is ignored.
+        usable = len(data) - len(data) % HEADER_SIZE
+        for start in range(0, usable, HEADER_SIZE):
+            header = Block.parse(BytesIO(data[start:start + HEADER_SIZE]))
+            if header.prev_block != self.tip():
+                raise ValueError('Headers file {} is corrupted.'.format(filename))
+            block_hash = header.hash()
+            self.heights[block_hash] = len(self.hashes)
+            self.hashes.append(block_hash)
+            self.work.append(self.work[-1] + block_work(header.bits))
+        self.raw += data[:usable]
+        if usable != len(data):
+            with open(filename, 'r+b') as f:
+                f.truncate(usable)
+
+    # Downloads every header after our tip from the node, until it has no more headers to give us.
+    # Returns the number of headers added.
+    def sync(self, node):
+        added = 0
+        while True:
+            getheaders = GetHeadersMessage(block_locator=self.locator())
+            node.send(getheaders)
+            received_headers = node.wait_for(HeadersMessage)
+            hashes = self.add_headers(received_headers.blocks)
+            added += len(hashes)
+            print(self)
+            # A headers message with less than the max. number of headers means we got to the node's tip.
+            # A full one that adds nothing won't get us any further either, so we stop there too.
+            if len(received_headers.blocks) < MAX_HEADERS or len(hashes) == 0:
+                return added
+
+
+class ChainTipTest(TestCase):
+
+    block1 = bytes.fromhex('010000006fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000982051fd1e4ba744bbbe680e1fee14677ba1a3c3540bf7b1cdb606e857233e0e61bc6649ffff001d01e36299')
+    block2 = bytes.fromhex('010000004860eb18bf1b1620e37e9490fc8a427514416fd75159ab86688e9a8300000000d5fdcc541e25de1c7a5addedf24858b8bb665c9f36ef744ee42c316022c90f9bb0bc6649ffff001d08d2bd61')
+
+    def test_genesis(self):
+        tip = ChainTip()
+        self.assertEqual(tip.hash.hex(), '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f')
+        self.assertEqual(tip.height, 0)
+
+    def test_connect_headers(self):
+        tip = ChainTip()
+        headers = [Block.parse(BytesIO(self.block1)), Block.parse(BytesIO(self.block2))]
+        hashes = tip.connect_headers(headers)
+        self.assertEqual(hashes[0].hex(), '00000000839a8e6886ab5951d76f411475428afc90947ee320161bbf18eb6048')
+        self.assertEqual(tip.hash.hex(), '000000006a625f06636b8bb6ac7b960a8d03705d1ace08b1a19da3fdcc99ddbd')
+        self.assertEqual(tip.height, 2)
+
+    def test_connect_wrong_block(self):
+        tip = ChainTip()
+        with self.assertRaises(ValueError):
+            tip.connect(Block.parse(BytesIO(self.block2)))
+        self.assertEqual(tip.height, 0)
+
+    def test_connect_bad_pow(self):
+        tip = ChainTip()
+        header = Block.parse(BytesIO(self.block1))
+        header.nonce = b'\x00' * 4
+        with self.assertRaises(ValueError):
+            tip.connect(header)
+
+
+class HeaderChainTest(TestCase):
+
+    # Node that answers getheaders with the headers after the given start block.
+    class FakeNode:
+
+        def __init__(self, headers):
+            self.headers = headers
+            self.block_locator = None
+
+        def send(self, message):
+            self.block_locator = message.block_locator
+
+        def wait_for(self, *message_classes):
+            hashes = [header.hash() for header in self.headers]
+            for block_hash in self.block_locator:
+                if block_hash in hashes:
+                    return HeadersMessage(self.headers[hashes.index(block_hash) + 1:])
+            return HeadersMessage(self.headers)
+
+    def headers(self):
+        return [Block.parse(BytesIO(ChainTipTest.block1)), Block.parse(BytesIO(ChainTipTest.block2))]
+
+    def test_add_headers(self):
+        chain = HeaderChain()
+        chain.add_headers(self.headers())
+        self.assertEqual(chain.height(), 2)
+        self.assertEqual(chain.tip().hex(), '000000006a625f06636b8bb6ac7b960a8d03705d1ace08b1a19da3fdcc99ddbd')
+        self.assertEqual(chain.height_of(chain.hash_at(1)), 1)
+        self.assertEqual(chain.header(1).serialize(), ChainTipTest.block1)
+        with self.assertRaises(ValueError):
+            chain.add(self.headers()[0])
+
+    def test_bad_bits(self):
+        chain = HeaderChain()
+        header = self.headers()[0]
+        header.bits = bytes.fromhex('ffff001c')
+        with self.assertRaises(ValueError):
+            chain.add(header)
+
+    def test_sync_and_load(self):
+        import tempfile
+        filename = os.path.join(tempfile.mkdtemp(), 'headers.dat')
+        chain = HeaderChain(filename)
+        self.assertEqual(chain.sync(self.FakeNode(self.headers())), 2)
+        chain.file.close()
+        # A partially written header is dropped when loading.
+        with open(filename, 'ab') as f:
+            f.write(b'\x01' * 10)
+        loaded = HeaderChain(filename)
+        self.assertEqual(loaded.height(), 2)
+        self.assertEqual(loaded.tip(), chain.tip())
+        self.assertEqual(loaded.sync(self.FakeNode(self.headers())), 0)
+        loaded.file.close()
+        self.assertEqual(os.path.getsize(filename), 160)
+
+    def test_locator(self):
+        chain = HeaderChain()
+        # We fake a long chain, the locator only needs the hashes.
+        chain.hashes = [bytes([i % 256]) + i.to_bytes(31, 'big') for i in range(1000)]
+        locator = chain.locator()
+        heights = [int.from_bytes(block_hash[1:], 'big') for block_hash in locator]
+        self.assertEqual(heights[:10], list(range(999, 989, -1)))
+        self.assertEqual(heights[10:13], [988, 984, 976])
+        self.assertEqual(heights[-1], 0)
+        self.assertTrue(len(locator) < 30)
+
+    def test_fork(self):
+        chain = HeaderChain()
+        chain.add_headers(self.headers())
+        chain.rewind(1)
+        self.assertEqual(chain.height(), 1)
+        self.assertIsNone(chain.height_of(self.headers()[1].hash()))
+        self.assertEqual(chain.add_headers(self.headers()[1:])[0], self.headers()[1].hash())
+        self.assertEqual(chain.height(), 2)
+        # A branch from block 1 with the same work as ours doesn't replace it.
+        self.assertEqual(chain.add_headers(self.headers()[1:]), [])
+        self.assertEqual(chain.height(), 2)
+        self.assertEqual(len(chain.raw), 3 * HEADER_SIZE)
+
+    # Headers whose PoW we don't check, so we can build competing branches.
+    class FakeHeader(Block):
+        def check_pow(self):
+            return True
+
+    def branch(self, prev_block, bits, n):
+        headers = []
+        for i in range(n):
+            header = self.FakeHeader(1, prev_block, bytes.fromhex(bits) * 8, i, bytes.fromhex(bits), b'\x00' * 4)
+            headers.append(header)
+            prev_block = header.hash()
+        return headers
+
+    def test_branch_with_more_work(self):
+        import tempfile
+        filename = os.path.join(tempfile.mkdtemp(), 'headers.dat')
+        # The difficulty is not checked on testnet.
+        chain = HeaderChain(filename, testnet=True)
+        easy = self.branch(chain.tip(), 'ffff001d', 3)
+        chain.add_headers(easy)
+        self.assertEqual(chain.height(), 3)
+        # A shorter branch from block 1 with less work is ignored.
+        self.assertEqual(chain.add_headers(self.branch(easy[0].hash(), 'ffff001d', 1)), [])
+        self.assertEqual(chain.tip(), easy[-1].hash())
+        # A shorter branch from block 1 with more work replaces our blocks after block 1.
+        hard = self.branch(easy[0].hash(), 'ffff001c', 1)
+        self.assertEqual(chain.add_headers(hard), [hard[0].hash()])
+        self.assertEqual(chain.height(), 2)
+        self.assertIsNone(chain.height_of(easy[1].hash()))
+        self.assertEqual(chain.chain_work(), chain.chain_work(1) + block_work(bytes.fromhex('ffff001c')))
+        chain.file.close()
+        loaded = HeaderChain(filename, testnet=True)
+        self.assertEqual(loaded.tip(), hard[0].hash())
+        self.assertEqual(loaded.chain_work(), chain.chain_work())
+        loaded.file.close()
+
+    def test_sync_full_batch_of_weaker_branch(self):
+        # Node that always answers with the same full batch of headers from a branch with less work.
+        class StubbornNode:
+            def __init__(self, headers):
+                self.headers = headers
+
+            def send(self, message):
+                pass
+
+            def wait_for(self, *message_classes):
+                return HeadersMessage(self.headers)
+
+        chain = HeaderChain(testnet=True)
+        hard = self.branch(chain.tip(), 'ffff001c', MAX_HEADERS + 1)
+        chain.add_headers(hard)
+        easy = self.branch(hard[0].hash(), 'ffff001d', MAX_HEADERS)
+        # The batch adds nothing, so we stop asking instead of getting it again forever.
+        self.assertEqual(chain.sync(StubbornNode(easy)), 0)
+        self.assertEqual(chain.tip(), hard[-1].hash())
@@ -0,0 +1,391 @@
+import queue
+import threading
+import time
+
+from collections import deque
+from unittest import TestCase
+
+from .blockparser import parse_block
+from .network import (
+    BlockMessage,
+    GetDataMessage,
+    NetworkEnvelope,
+    SimpleNode,
+    MSG_WITNESS_BLOCK
+)
+
+
+# Downloads blocks from a SimpleNode keeping several getdata requests in flight, instead of waiting
+# for each block before asking for the next one. Blocks can arrive in any order, so they are kept
+# until every block before them has arrived and are handed out in the order they were asked for.
+class BlockDownloader:
+
+    def __init__(self, node, window=16, data_type=MSG_WITNESS_BLOCK):
+        self.node = node
+        # Max. number of blocks requested but not handed out yet.
+        self.window = window
+        self.data_type = data_type
+        # Total size of the block payloads received so far.
+        self.bytes_received = 0
+
+    # Asks for as many of the pending hashes as the window allows, with a single getdata message.
+    def request(self, pending, in_flight):
+        getdata = GetDataMessage()
+        while len(pending) > 0 and len(in_flight) < self.window:
+            block_hash = pending.popleft()
+            getdata.add_data(self.data_type, block_hash)
+            in_flight.add(block_hash)
+        if len(getdata.data) > 0:
+            self.node.send(getdata)
+
+    # Receives the next block message from the node. Returns its hash and the parsed BlockMessage.
+    def receive(self):
+        envelope = self.node.wait_for_envelope(BlockMessage)
+        self.bytes_received += len(envelope.payload)
+        # Scripts are parsed only if somebody accesses them.
+        received_block = parse_block(envelope.payload, lazy=True)
+        return received_block.hash(), received_block
+
+    # Generator that downloads the blocks with the given hashes and yields them (as BlockMessage objects)
+    # in the same order as the hashes.
+    def download(self, block_hashes):
+        order = list(block_hashes)
+        pending = deque(order)
+        in_flight = set()
+        # Blocks that arrived before some of the blocks that come before them.
+        received = {}
+        for block_hash in order:
+            # We keep the window full while we wait for the next block in order.
+            while block_hash not in received:
+                self.request(pending, in_flight)
+                received_hash, received_block = self.receive()
+                # We ignore blocks we didn't ask for (e.g. new blocks announced by the node).
+                if received_hash in in_flight:
+                    received[received_hash] = received_block
+            in_flight.discard(block_hash)
+            yield received.pop(block_hash)
+
+
+# A connection to a node used by PeerPool, with the stats needed to score it.
+class Peer:
+
+    def __init__(self, node, host=None):
+        self.node = node
+        self.host = host
+        self.alive = True
+        # Bytes of blocks delivered by this peer and seconds it spent delivering them.
+        self.bytes_received = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return 'peer: {} rate: {:.0f} B/s'.format(self.host, self.rate())
+
+    # Opens a SimpleNode connection to the host and does the handshake.
+    @classmethod
+    def connect(cls, host, port=None, testnet=False, timeout=60):
+        node = SimpleNode(host, port, testnet, timeout=timeout)
+        node.handshake()
+        return cls(node, host)
+
+    # Returns the peer's score: delivered bytes per second.
+    def rate(self):
+        if self.seconds == 0:
+            return 0
+        return self.bytes_received / self.seconds
+
+    # Stops using this peer and closes its connection.
+    def drop(self):
+        self.alive = False
+        try:
+            self.node.close()
+        except OSError:
+            pass
+
+
+# Downloads blocks from several peers at the same time. The hashes are split in ranges of consecutive
+# blocks, and each peer (in its own thread) takes the next range nobody is working on, so fast peers end up
+# downloading more ranges than slow ones. A range that takes longer than stall_timeout is given to another
+# peer and the stalled peer is dropped. Blocks are handed out in the same order as the hashes.
+class PeerPool:
+
+    def __init__(self, peers, range_size=16, window=16, stall_timeout=60, max_ranges_ahead=None):
+        self.peers = list(peers)
+        # Number of consecutive blocks a peer downloads at once.
+        self.range_size = range_size
+        # Number of blocks each peer keeps in flight.
+        self.window = window
+        self.stall_timeout = stall_timeout
+        # Max. number of ranges downloaded ahead of the one we're waiting for, so memory stays bounded.
+        if max_ranges_ahead is None:
+            max_ranges_ahead = 4 * len(self.peers)
+        self.max_ranges_ahead = max_ranges_ahead
+        # (port, testnet, timeout) used to connect to the hosts again, if the pool was made with connect.
+        self.connect_options = None
+
+    # Connects to every host we can. Hosts we can't connect to are skipped.
+    @classmethod
+    def connect(cls, hosts, port=None, testnet=False, timeout=60, **kwargs):
+        peers = []
+        for host in hosts:
+            try:
+                peers.append(Peer.connect(host, port, testnet, timeout))
+            except (OSError, SyntaxError) as e:
+                print('could not connect to {}: {}'.format(host, e))
+        if len(peers) == 0:
+            raise RuntimeError('Could not connect to any peer.')
+        pool = cls(peers, stall_timeout=timeout, **kwargs)
+        pool.connect_options = (port, testnet, timeout)
+        return pool
+
+    # Opens a new connection to a host, with the options the pool was made with.
+    def connect_peer(self, host):
+        port, testnet, timeout = self.connect_options
+        return Peer.connect(host, port, testnet, timeout)
+
+    # Connects again to the hosts of the peers that were dropped. Raises RuntimeError if no peer is left.
+    def reconnect(self):
+        if self.connect_options is not None:
+            for i, peer in enumerate(self.peers):
+                if peer.alive:
+                    continue
+                try:
+                    self.peers[i] = self.connect_peer(peer.host)
+                    print('reconnected to {}'.format(peer.host))
+                except (OSError, SyntaxError) as e:
+                    print('could not reconnect to {}: {}'.format(peer.host, e))
+        if len(self.alive_peers()) == 0:
+            raise RuntimeError('All peers failed and none could be reconnected.')
+
+    # Returns the peers that are still connected, best scored first.
+    def alive_peers(self):
+        peers = [peer for peer in self.peers if peer.alive]
+        return sorted(peers, key=lambda peer: peer.rate(), reverse=True)
+
+    # Generator that downloads the blocks with the given hashes from all the peers and yields them
+    # (as BlockMessage objects) in the same order as the hashes.
+    def download(self, block_hashes):
+        # Peers dropped during the previous downloads are replaced first.
+        self.reconnect()
+        hashes = list(block_hashes)
+        self.ranges = [hashes[i:i + self.range_size] for i in range(0, len(hashes), self.range_size)]
+        # Indexes of the ranges nobody is working on. Lowest index goes first.
+        self.work = queue.PriorityQueue()
+        for i in range(len(self.ranges)):
+            self.work.put(i)
+        # Downloaded ranges by index.
+        self.results = {}
+        # Ranges being downloaded by index: (peer, time the download started).
+        self.started = {}
+        # Index of the range we're waiting for.
+        self.next_range = 0
+        self.done = False
+        self.condition = threading.Condition()
+        threads = []
+        for peer in self.alive_peers():
+            thread = threading.Thread(target=self.worker, args=(peer,), daemon=True)
+            thread.start()
+            threads.append(thread)
+        try:
+            for i in range(len(self.ranges)):
+                for block in self.wait_for_range(i):
+                    yield block
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+            # We wait for the workers to stop, so nobody else is reading from the nodes' sockets.
+            for thread in threads:
+                thread.join()
+
+    # Waits until range i has been downloaded and returns its blocks.
+    def wait_for_range(self, i):
+        with self.condition:
+            self.next_range = i
+            self.condition.notify_all()
+            while i not in self.results:
+                if len(self.alive_peers()) == 0:
+                    raise RuntimeError('All peers failed.')
+                self.condition.wait(timeout=1)
+                # If the range is taking too long, another peer gets it.
+                if i in self.started and i not in self.results:
+                    peer, start = self.started[i]
+                    if time.time() - start > self.stall_timeout:
+                        print('{} stalled, reassigning blocks'.format(peer))
+                        del self.started[i]
+                        self.work.put(i)
+                        peer.drop()
+            return self.results.pop(i)
+
+    # Runs in a thread for each peer, downloading ranges until there's no work left or the peer fails.
+    def worker(self, peer):
+        downloader = BlockDownloader(peer.node, self.window)
+        while peer.alive and not self.done:
+            try:
+                i = self.work.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self.condition:
+                # We don't get too far ahead of the range we're waiting for. The range goes back to the queue
+                # while we wait, so we can take a range that is needed sooner (e.g. one a stalled peer had).
+                if i >= self.next_range + self.max_ranges_ahead:
+                    self.work.put(i)
+                    self.condition.wait(timeout=0.5)
+                    continue
+                # The range might have been downloaded already by another peer.
+                if self.done or i in self.results or i < self.next_range:
+                    continue
+                self.started[i] = (peer, time.time())
+            start = time.time()
+            bytes_before = downloader.bytes_received
+            try:
+                blocks = list(downloader.download(self.ranges[i]))
+            except (OSError, ValueError, SyntaxError, IndexError) as e:
+                with self.condition:
+                    # If the range was not reassigned already, we put it back for other peers.
+                    if i in self.started and self.started[i][0] is peer:
+                        del self.started[i]
+                        self.work.put(i)
+                    print('dropping {}: {}'.format(peer, e))
+                    peer.drop()
+                    self.condition.notify_all()
+                return
+            peer.seconds += time.time() - start
+            peer.bytes_received += downloader.bytes_received - bytes_before
+            with self.condition:
+                if i not in self.results and i >= self.next_range:
+                    self.results[i] = blocks
+                if i in self.started and self.started[i][0] is peer:
+                    del self.started[i]
+                self.condition.notify_all()
+
+
+class BlockDownloaderTest(TestCase):
+
+    # Node that answers every getdata with the requested blocks, in reverse order.
+    class FakeNode:
+
+        def __init__(self, blocks):
+            self.blocks = {block.hash(): block for block in blocks}
+            self.queue = deque()
+            self.sent = []
+
+        def send(self, message):
+            self.sent.append(message)
+            for _, block_hash in reversed(message.data):
+                self.queue.append(NetworkEnvelope(BlockMessage.command, self.blocks[block_hash].serialize()))
+
+        def wait_for_envelope(self, *message_classes):
+            return self.queue.popleft()
+
+    def make_blocks(self, n):
+        blocks = []
+        prev_block = b'\x00' * 32
+        for i in range(n):
+            block = BlockMessage(1, prev_block, b'\x00' * 32, i, b'\xff\xff\x00\x1d', b'\x00' * 4, 0, [])
+            blocks.append(block)
+            prev_block = block.hash()
+        return blocks
+
+    def test_download_in_order(self):
+        blocks = self.make_blocks(10)
+        node = self.FakeNode(blocks)
+        downloader = BlockDownloader(node, window=4)
+        hashes = [block.hash() for block in blocks]
+        downloaded = [block.hash() for block in downloader.download(hashes)]
+        self.assertEqual(downloaded, hashes)
+        # Several blocks are requested with each getdata message.
+        self.assertEqual(len(node.sent[0].data), 4)
+        self.assertTrue(len(node.sent) < len(blocks))
+
+    def test_window(self):
+        blocks = self.make_blocks(10)
+        node = self.FakeNode(blocks)
+        downloader = BlockDownloader(node, window=3)
+        hashes = [block.hash() for block in blocks]
+        for block in downloader.download(hashes):
+            requested = sum(len(message.data) for message in node.sent)
+            self.assertTrue(requested - hashes.index(block.hash()) <= 3)
+
+
+class PeerPoolTest(TestCase):
+
+    # Node that never answers, until it's closed.
+    class SilentNode:
+
+        def __init__(self):
+            self.closed = threading.Event()
+
+        def send(self, message):
+            pass
+
+        def wait_for_envelope(self, *message_classes):
+            self.closed.wait()
+            raise OSError('connection closed')
+
+        def close(self):
+            self.closed.set()
+
+    def make_blocks(self, n):
+        return BlockDownloaderTest.make_blocks(None, n)
+
+    def test_download(self):
+        blocks = self.make_blocks(50)
+        peers = [Peer(BlockDownloaderTest.FakeNode(blocks), i) for i in range(3)]
+        pool = PeerPool(peers, range_size=4, window=2)
+        hashes = [block.hash() for block in blocks]
+        downloaded = [block.hash() for block in pool.download(hashes)]
+        self.assertEqual(downloaded, hashes)
+        self.assertEqual(sum(peer.bytes_received for peer in peers), sum(len(block.serialize()) for block in blocks))
+        self.assertTrue(pool.alive_peers()[0].rate() > 0)
+
+    def test_stalled_peer(self):
+        blocks = self.make_blocks(20)
+        silent = Peer(self.SilentNode(), 'silent')
+        peers = [silent, Peer(BlockDownloaderTest.FakeNode(blocks), 'good')]
+        pool = PeerPool(peers, range_size=4, window=2, stall_timeout=0.5)
+        hashes = [block.hash() for block in blocks]
+        downloaded = [block.hash() for block in pool.download(hashes)]
+        self.assertEqual(downloaded, hashes)
+        self.assertFalse(silent.alive)
+        self.assertEqual(pool.alive_peers()[0].host, 'good')
+
+    # Runs pool.download in a thread and returns the hashes of the blocks it yielded, failing if it hangs.
+    def download_with_timeout(self, pool, hashes, timeout=30):
+        downloaded = []
+        thread = threading.Thread(target=lambda: downloaded.extend(block.hash() for block in pool.download(hashes)),
+                                  daemon=True)
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), 'download hung with {} of {} blocks'.format(len(downloaded), len(hashes)))
+        return downloaded
+
+    def test_stalled_peer_many_ranges(self):
+        # 15 ranges, more than max_ranges_ahead (8), so the good peer is already ahead when the silent
+        # one stalls on the first range.
+        blocks = self.make_blocks(60)
+        silent = Peer(self.SilentNode(), 'silent')
+        peers = [silent, Peer(BlockDownloaderTest.FakeNode(blocks), 'good')]
+        pool = PeerPool(peers, range_size=4, window=2, stall_timeout=0.5)
+        self.assertTrue(len(blocks) / 4 > pool.max_ranges_ahead)
+        hashes = [block.hash() for block in blocks]
+        self.assertEqual(self.download_with_timeout(pool, hashes), hashes)
+        self.assertFalse(silent.alive)
+
+    def test_reconnect(self):
+        blocks = self.make_blocks(8)
+
+        # Connects again to a node that answers.
+        class Pool(PeerPool):
+            def connect_peer(self, host):
+                return Peer(BlockDownloaderTest.FakeNode(blocks), host)
+
+        silent = Peer(self.SilentNode(), 'flaky')
+        pool = Pool([silent])
+        silent.drop()
+        # Pools that were not made with connect don't know how to connect again.
+        with self.assertRaises(RuntimeError):
+            pool.reconnect()
+        pool.connect_options = (None, False, 60)
+        hashes = [block.hash() for block in blocks]
+        self.assertEqual(self.download_with_timeout(pool, hashes), hashes)
+        self.assertEqual([peer.host for peer in pool.alive_peers()], ['flaky'])
@@ -264,16 +264,23 @@ class GetHeadersMessage:
 
     command = b'getheaders'
 
-    def __init__(self, version=70015, num_hashes=1, start_block=None, end_block=None):
+    def __init__(self, version=70015, num_hashes=None, start_block=None, end_block=None, block_locator=None):
         # Identifies protocol version being used by the node.
         self.version = version
-        # We're going to assume that the number of block header groups is 1.
-        # A more robust implementation would be able to handle more than 1.
-        self.num_hashes = num_hashes
-        # Hash of the start block header.
-        if start_block is None:
-            raise RuntimeError("A start block is required.")
-        self.start_block = start_block
+        # The block locator is a list of hashes of our chain, starting from our tip and going back
+        # exponentially to the genesis block. The node answers with the headers that come after the
+        # first hash it has in its best chain, so it finds where our chains split in one round trip.
+        # A single start block is a locator of one hash.
+        if block_locator is None:
+            if start_block is None:
+                raise RuntimeError("A start block is required.")
+            block_locator = [start_block]
+        self.block_locator = block_locator
+        self.num_hashes = len(block_locator)
+        if num_hashes is not None and num_hashes != self.num_hashes:
+            raise RuntimeError('num_hashes does not match the block locator.')
+        # Hash of the start block header (the most recent hash of the locator).
+        self.start_block = block_locator[0]
         # Hash of the last desired block header; set to zero to get as many blocks as possible
         if end_block is None:
             self.end_block = b'\x00' * 32
@@ -284,8 +291,9 @@ class GetHeadersMessage:
     def serialize(self):
         result = int_to_little_endian(self.version, 4)
         result += encode_varint(self.num_hashes)
-        # start and end block are already in bytes, so we just convert them to LE.
-        result += self.start_block[::-1]
+        # hashes of the locator and end block are already in bytes, so we just convert them to LE.
+        for block_hash in self.block_locator:
+            result += block_hash[::-1]
         result += self.end_block[::-1]
         return result
 
@@ -294,9 +302,26 @@ class GetHeadersMessage:
     def parse(cls, stream):
         version = little_endian_to_int(stream.read(4))
         num_hashes = read_varint(stream)
-        start_block = stream.read(32)[::-1]
+        block_locator = [stream.read(32)[::-1] for _ in range(num_hashes)]
         end_block = stream.read(32)[::-1]
-        return cls(version, num_hashes, start_block, end_block)
+        return cls(version, num_hashes, end_block=end_block, block_locator=block_locator)
+
+
+class GetHeadersMessageTest(TestCase):
+
+    def test_serialize(self):
+        block_hex = '0000000000000000001237f46acddf58578a37e213d2a6edc4884a2fcad05ba3'
+        gh = GetHeadersMessage(start_block=bytes.fromhex(block_hex))
+        self.assertEqual(gh.serialize().hex(), '7f11010001a35bd0ca2f4a88c4eda6d213e2378a5758dfcd6af437120000000000000000000000000000000000000000000000000000000000000000000000000000000000')
+
+    def test_block_locator(self):
+        locator = [bytes([i]) * 32 for i in range(3)]
+        gh = GetHeadersMessage(block_locator=locator)
+        parsed = GetHeadersMessage.parse(BytesIO(gh.serialize()))
+        self.assertEqual(parsed.num_hashes, 3)
+        self.assertEqual(parsed.block_locator, locator)
+        self.assertEqual(parsed.start_block, locator[0])
+        self.assertEqual(parsed.end_block, b'\x00' * 32)
 
 
 # When we ask for some headers with a getheaders command (GetHeadersMessage), the other node will
@@ -363,6 +388,8 @@ class GetDataMessage:
 class BlockMessage:
 
     command = b'block'
+    # The serialized block, when it was parsed by blockparser.parse_block.
+    raw = None
 
     def __init__(self, version, prev_block, merkle_root, timestamp, bits, nonce, txn_count, txns):
         self.version = version
@@ -387,7 +414,15 @@ class BlockMessage:
         for _ in range(txn_count):
             txns.append(Tx.parse(stream))
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce, txn_count, txns)
-    
+
+    # Returns the header of this block as a Block object.
+    def header(self):
+        return Block(self.version, self.prev_block, self.merkle_root, self.timestamp, self.bits, self.nonce)
+
+    # Returns the hash of the block, which is the hash of its header.
+    def hash(self):
+        return self.header().hash()
+
     def serialize(self):
         result = int_to_little_endian(self.version, 4)
         result += self.prev_block[::-1]
@@ -404,7 +439,7 @@ class BlockMessage:
 class SimpleNode:
 
     # port and host are the port and host we want to connect to.
-    def __init__(self, host, port=None, testnet=False, logging=False):
+    def __init__(self, host, port=None, testnet=False, logging=False, timeout=None):
         if port is None:
             if testnet:
                 port = 18333
@@ -420,6 +455,8 @@ class SimpleNode:
         # TCP relieves you from having to worry about packet loss, data arriving out-of-order,
         # and many other things that invariably happen when you’re communicating across a network.
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # seconds to wait on connect and on every read before giving up on the node. None waits forever.
+        self.socket.settimeout(timeout)
         # connect() is used to connect to the server. host is the server's IP address and port is the
         # port used by the server.
         self.socket.connect((host, port))
@@ -427,6 +464,11 @@ class SimpleNode:
         # passed to all the parse methods - page 181.
         self.stream = self.socket.makefile('rb', None)
 
+    # closes the connection with the node.
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
     # send a message to the connected node.
     def send(self, message):
         # the command property and serialize method are expected to exist in the message object - page 183.
@@ -446,24 +488,28 @@ class SimpleNode:
     # lets us wait for any one of several messages (message classes) - page 183.
     # note: a commercial-strength would not use something like this.
     def wait_for(self, *message_classes):
-        command = None
+        envelope = self.wait_for_envelope(*message_classes)
         command_to_class = {m.command: m for m in message_classes}
+        # return the envelope parsed as a member of the right message class.
+        return command_to_class[envelope.command].parse(envelope.stream())
+
+    # same as wait_for, but returns the NetworkEnvelope without parsing it, so the caller
+    # has access to the raw payload.
+    def wait_for_envelope(self, *message_classes):
+        command = None
+        commands = {m.command for m in message_classes}
         # loop until the command is in the commands we want.
-        while command not in command_to_class.keys():
+        while command not in commands:
             # get the next network message.
             envelope = self.read()
-            print('envelope', envelope)
             # set the command to be evaluated.
             command = envelope.command
-            print('command', command)
             # we know how to respond to version and ping, handle that here.
             if command == VersionMessage.command:
-                print('VersionMessage', envelope.payload)
                 self.send(VerAckMessage())
             elif command == PingMessage.command:
                 self.send(PongMessage(envelope.payload))
-        # return the envelope parsed as a member of the right message class.
-        return command_to_class[command].parse(envelope.stream())
+        return envelope
 
     # The network handshake is how nodes establish communication - page 181.
     # Handshake is sending a version message and getting a verack back.
@@ -299,7 +299,7 @@ class Script:
         return len(self.cmds) == 2 and type(self.cmds[0]) == bytes and self.cmds[1] == 172
 
     def is_op_return_pubkey(self):
-        return self.cmds[0] == 106
+        return len(self.cmds) > 0 and self.cmds[0] == 106
 
     # Returns the address corresponding to the script
     def address(self, testnet=False):
@@ -333,7 +333,8 @@ class Script:
         if not self.is_op_return_pubkey():
             raise ValueError('Not OP_RETURN output')
         else:
-            data = self.cmds[1]
+            # A bare OP_RETURN (or one followed by opcodes) carries no data.
+            data = self.cmds[1] if len(self.cmds) > 1 and type(self.cmds[1]) == bytes else b''
             data_hex = data.hex()
             data_str = bytes.fromhex(data_hex).decode('utf-8', errors='ignore')
             return data_str
\ No newline at end of file
@@ -1,8 +1,12 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from unittest import TestCase
 from .script import Script, p2pkh_script
 
 import json
+import os
+import tempfile
 import requests
 
 from .helper import (
@@ -16,13 +20,68 @@ from .helper import (
 )
 
 from .ecc import (PrivateKey)
+from .txstore import TxStore
+
+# Transactions by id, bounded by the total size of their serializations (max_bytes). The least recently
+# used ones are dropped first. A tx can be added serialized, in which case it's only parsed when it's needed.
+class TxCache:
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # tx id -> (Tx or serialization, size of the serialization)
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, tx_id):
+        return tx_id in self.entries
+
+    # Adds a tx, either parsed or serialized. size is the length of the serialization.
+    def put(self, tx_id, tx, size=None):
+        if size is None:
+            size = len(tx) if isinstance(tx, bytes) else len(tx.serialize())
+        old = self.entries.pop(tx_id, None)
+        if old is not None:
+            self.size -= old[1]
+        self.entries[tx_id] = (tx, size)
+        self.size += size
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, (_, dropped_size) = self.entries.popitem(last=False)
+            self.size -= dropped_size
+
+    # Returns the parsed tx, or None if it's not in the cache.
+    def get(self, tx_id):
+        entry = self.entries.get(tx_id)
+        if entry is None:
+            return None
+        self.entries.move_to_end(tx_id)
+        tx, size = entry
+        if isinstance(tx, bytes):
+            tx = Tx.parse(BytesIO(tx))
+            self.entries[tx_id] = (tx, size)
+        return tx
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
 
 # class to be able to access the UTXO set end look up individual transactions and be able to get input amounts.
 
 
 class TxFetcher:
 
-    cache = {}
+    cache = TxCache()
+    # File where every fetched tx is saved (see txstore.TxStore), set with open_store.
+    store = None
+    # Local UTXO set (see utxo.UtxoSet). If set, outputs are looked up there before fetching their tx.
+    utxo_set = None
+    # Used for every request, so that the connections to the server are reused.
+    session = requests.Session()
+    # Max. number of txs downloaded at the same time by prefetch.
+    max_workers = 16
 
     @classmethod
     def get_url(cls, testnet=False):
@@ -31,31 +90,106 @@ class TxFetcher:
         else:
             return 'http://mainnet.programmingbitcoin.com'
 
+    # Saves the fetched txs to the given file, and looks them up there before fetching them again.
+    @classmethod
+    def open_store(cls, filename):
+        if cls.store is not None:
+            cls.store.close()
+        cls.store = TxStore(filename)
+
+    # Returns the tx from the cache or the store, or None if it's in neither.
+    @classmethod
+    def get_saved(cls, tx_id):
+        tx = cls.cache.get(tx_id)
+        if tx is None and cls.store is not None:
+            raw = cls.store.get(bytes.fromhex(tx_id))
+            if raw is not None:
+                tx = Tx.parse(BytesIO(raw))
+                cls.cache.put(tx_id, tx, len(raw))
+        return tx
+
+    # Downloads a tx from the server. Returns the parsed tx and its serialization.
+    @classmethod
+    def download(cls, tx_id, testnet=False):
+        url = '{}/tx/{}.hex'.format(cls.get_url(testnet), tx_id)
+        response = cls.session.get(url)
+        try:
+            raw = bytes.fromhex(response.text.strip())
+        except ValueError:
+            raise ValueError(
+                'unexpected response: {}'.format(response.text))
+        tx = Tx.parse(BytesIO(raw), testnet=testnet)
+        # make sure the tx we got matches to the hash we requested
+        if tx.id() != tx_id:
+            raise RuntimeError(
+                'server lied: {} vs {}'.format(tx.id(), tx_id))
+        return tx, raw
+
+    # Adds a downloaded tx to the cache and the store.
+    @classmethod
+    def save(cls, tx_id, tx, raw):
+        cls.cache.put(tx_id, tx, len(raw))
+        if cls.store is not None:
+            cls.store.append(tx.hash(), raw)
+
     # fecthes a transaction from the UTXO set.
     @classmethod
     def fetch(cls, tx_id, testnet=False, fresh=False):
-        if fresh or (tx_id not in cls.cache):
-            url = '{}/tx/{}.hex'.format(cls.get_url(testnet), tx_id)
-            response = requests.get(url)
-            try:
-                raw = bytes.fromhex(response.text.strip())
-            except ValueError:
-                raise ValueError(
-                    'unexpected response: {}'.format(response.text))
-            tx = Tx.parse(BytesIO(raw), testnet=testnet)
-            # make sure the tx we got matches to the hash we requested
-            if tx.id() != tx_id:
-                raise RuntimeError(
-                    'server lied: {} vs {}'.format(tx.id(), tx_id))
-            cls.cache[tx_id] = tx
-        cls.cache[tx_id].testnet = testnet
-        return cls.cache[tx_id]
-
+        tx = None if fresh else cls.get_saved(tx_id)
+        if tx is None:
+            tx, raw = cls.download(tx_id, testnet=testnet)
+            cls.save(tx_id, tx, raw)
+        tx.testnet = testnet
+        return tx
+
+    # Downloads the given txs that are not saved yet, max_workers at a time, so that fetching them
+    # afterwards doesn't wait for the server.
+    @classmethod
+    def prefetch(cls, tx_ids, testnet=False):
+        missing = [tx_id for tx_id in set(tx_ids) if cls.get_saved(tx_id) is None]
+        if len(missing) == 0:
+            return
+        # Only the downloads run in the pool; the cache and the store are only used from this thread.
+        with ThreadPoolExecutor(max_workers=min(cls.max_workers, len(missing))) as pool:
+            for tx_id, (tx, raw) in zip(missing, pool.map(lambda tx_id: cls.download(tx_id, testnet), missing)):
+                cls.save(tx_id, tx, raw)
+
+    # Prefetches the txs spent by the inputs of the given txs (e.g. the txs of a block), so that their fees
+    # can be computed and their inputs verified. Outputs found in the UTXO set and outputs of the given txs
+    # themselves are not downloaded.
+    @classmethod
+    def prefetch_inputs(cls, txs, testnet=False):
+        own = {}
+        for tx in txs:
+            own[tx.id()] = tx
+        tx_ids = []
+        for tx in txs:
+            if tx.is_coinbase():
+                continue
+            for tx_in in tx.tx_inputs:
+                tx_id = tx_in.prev_tx.hex()
+                if tx_id in own:
+                    cls.cache.put(tx_id, own[tx_id])
+                elif cls.utxo_set is None or cls.utxo_set.testnet != testnet \
+                        or cls.utxo_set.get(tx_in.prev_tx, tx_in.prev_index) is None:
+                    tx_ids.append(tx_id)
+        cls.prefetch(tx_ids, testnet=testnet)
+
+    # Returns the output of the given tx at the given index, as a TxOut.
+    @classmethod
+    def fetch_output(cls, tx_id, index, testnet=False):
+        if cls.utxo_set is not None and cls.utxo_set.testnet == testnet:
+            tx_out = cls.utxo_set.get(bytes.fromhex(tx_id), index)
+            if tx_out is not None:
+                return tx_out
+        return cls.fetch(tx_id, testnet=testnet).tx_outputs[index]
+
+    # Loads a JSON file of serialized txs by id. They're parsed when they're fetched.
     @classmethod
     def load_cache(cls, filename):
         disk_cache = json.loads(open(filename, 'r').read())
         for k, raw_hex in disk_cache.items():
-            cls.cache[k] = Tx.parse(BytesIO(bytes.fromhex(raw_hex)))
+            cls.cache.put(k, bytes.fromhex(raw_hex))
 
 # class that represents a Bitcoin transaction - page 88
 
@@ -75,6 +209,9 @@ class Tx:
         self._hash_prevouts = None
         self._hash_sequence = None
         self._hash_outputs = None
+        # txid and wtxid, computed the first time they're needed (or by the parser, from the raw bytes).
+        self._hash = None
+        self._witness_hash = None
 
     def __repr__(self):
         tx_inputs = ''
@@ -90,8 +227,29 @@ class Tx:
         return self.hash().hex()
 
     # binary hash of the legacy serialization in little endian.
+    # For segwit transactions the witness is not part of the txid, so we always hash the legacy serialization.
     def hash(self):
-        return hash256(self.serialize())[::-1]
+        if self._hash is None:
+            self._hash = hash256(self.serialize_legacy())[::-1]
+        return self._hash
+
+    # hexadecimal value of the hash including the witness (wtxid). Same as id() for legacy transactions.
+    def wtxid(self):
+        return self.witness_hash().hex()
+
+    # binary hash of the full serialization (with the witness for segwit) in little endian.
+    def witness_hash(self):
+        if self._witness_hash is None:
+            if self.segwit:
+                self._witness_hash = hash256(self.serialize_segwit())[::-1]
+            else:
+                self._witness_hash = self.hash()
+        return self._witness_hash
+
+    # Forgets the cached hashes. Needs to be called after changing the transaction (e.g. when signing).
+    def reset_hashes(self):
+        self._hash = None
+        self._witness_hash = None
 
     # method that defines which parse method to use: segwit or legacy - page 231.
     @classmethod
@@ -99,7 +257,6 @@ class Tx:
         s.read(4)
         # if, after version (which is first 4 bytes), we have a 0 byte, it means the transaction is segwit.
         flag = s.read(1)
-        print('flag', flag)
         if flag == b'\x00':
             parse_method = cls.parse_segwit
         else:
@@ -136,7 +293,6 @@ class Tx:
     # Parser when tx is segwit.
     @classmethod
     def parse_segwit(cls, s, testnet=False):
-        print("SEGWIT***************************************")
         version = little_endian_to_int(s.read(4))
         # Marker and flag are 2 bytes after version - page 232.
         marker_and_flag = s.read(2)
@@ -224,6 +380,8 @@ class Tx:
 
     # returns the implied fee of the transaction in satoshis.
     def fee(self):
+        # download the txs spent by the inputs all at once.
+        TxFetcher.prefetch_inputs([self], self.testnet)
         total_input = 0
         # loop over the inputs summing their values.
         for tx_input in self.tx_inputs:
@@ -231,7 +389,7 @@ class Tx:
         total_output = 0
         # loop over the outputs summing their values.
         for tx_output in self.tx_outputs:
-            total_output += tx_output.amount()
+            total_output += tx_output.amount
         # fee equals total inputs - total outputs
         return total_input - total_output
 
@@ -401,6 +559,8 @@ class Tx:
         script_sig = Script([sig, sec])
         # add the ScriptSig to the given input.
         self.tx_inputs[input_index].script_sig = script_sig
+        # the txid changed.
+        self.reset_hashes()
         # verify the input was signed correctly.
         return self.verify_input(input_index)
 
@@ -453,35 +613,38 @@ class TxIn:
         # get prev_index in byte format.
         prev_index = int_to_little_endian(self.prev_index, 4)
         # get script_sig in byte format.
-        if self.script_sig is None:
-            script_sig = b'\x00'
-        else:
-            script_sig = self.script_sig.serialize()
+        script_sig = self.serialize_script_sig()
         # get sequence in byte_format.
         sequence = int_to_little_endian(self.sequence, 4)
         return prev_tx + prev_index + script_sig + sequence
 
+    # returns the serialization of the ScriptSig (with its length in front).
+    def serialize_script_sig(self):
+        if self.script_sig is None:
+            return b'\x00'
+        return self.script_sig.serialize()
+
     # fetches previous transaction. Done to be able to check this tx's inputs (prev tx's outputs) amounts.
     def fetch_tx(self, testnet=False):
         return TxFetcher.fetch(self.prev_tx.hex(), testnet=testnet)
 
+    # fetches the output this input spends, from the UTXO set if possible or else from its transaction.
+    def fetch_output(self, testnet=False):
+        return TxFetcher.fetch_output(self.prev_tx.hex(), self.prev_index, testnet=testnet)
+
     # returns the value of this tx input.
     def value(self, testnet=False):
-        # we fetch the previous transaction
-        tx = self.fetch_tx(testnet=testnet)
-        # we return the amount of the tx output at the given index = this tx's spendable amount.
-        return tx.tx_outputs[self.prev_index].amount
+        # we return the amount of the output this input spends = this tx's spendable amount.
+        return self.fetch_output(testnet=testnet).amount
 
     # Returns the ScriptPubKey for the output that this inputs is trying to spend.
     def script_pubkey(self, testnet=False):
         '''Get the ScriptPubKey by looking up the tx hash
         Returns a Script object
         '''
-        # use self.fetch_tx to get the transaction
-        tx = self.fetch_tx(testnet=testnet)
-        # get the output at self.prev_index
+        # get the output at self.prev_index of the previous transaction
         # return the script_pubkey property
-        return tx.tx_outputs[self.prev_index].script_pubkey
+        return self.fetch_output(testnet=testnet).script_pubkey
 
 # class that represents a transaction output
 
@@ -510,9 +673,13 @@ class TxOut:
         # get the amount in byte format.
         amount = int_to_little_endian(self.amount, 8)
         # get the script_pubkey in byte format.
-        script_pubkey = self.script_pubkey.serialize()
+        script_pubkey = self.serialize_script_pubkey()
         return amount + script_pubkey
 
+    # returns the serialization of the ScriptPubKey (with its length in front).
+    def serialize_script_pubkey(self):
+        return self.script_pubkey.serialize()
+
 
 class TxTest(TestCase):
     cache_file = './tx.cache'
@@ -563,6 +730,18 @@ class TxTest(TestCase):
         tx = Tx.parse(stream)
         self.assertEqual(tx.locktime, 410393)
 
+    def test_id(self):
+        # The cache is keyed by txid, and has both legacy and segwit transactions.
+        with open(self.cache_file, 'r') as f:
+            disk_cache = json.loads(f.read())
+        for tx_id, raw_hex in disk_cache.items():
+            tx = Tx.parse(BytesIO(bytes.fromhex(raw_hex)))
+            self.assertEqual(tx.id(), tx_id)
+            if tx.segwit:
+                self.assertEqual(tx.wtxid(), hash256(bytes.fromhex(raw_hex))[::-1].hex())
+            else:
+                self.assertEqual(tx.wtxid(), tx_id)
+
     def test_fee(self):
         raw_tx = bytes.fromhex('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
         stream = BytesIO(raw_tx)
@@ -572,3 +751,63 @@ class TxTest(TestCase):
         stream = BytesIO(raw_tx)
         tx = Tx.parse(stream)
         self.assertEqual(tx.fee(), 140500)
+
+    def test_cache_size(self):
+        with open(self.cache_file, 'r') as f:
+            raw_txs = [(tx_id, bytes.fromhex(raw_hex)) for tx_id, raw_hex in json.loads(f.read()).items()]
+        (id_1, raw_1), (id_2, raw_2), (id_3, raw_3) = raw_txs[:3]
+        cache = TxCache(max_bytes=len(raw_1) + len(raw_2) + len(raw_3) - 1)
+        cache.put(id_1, raw_1)
+        cache.put(id_2, raw_2)
+        # Txs are parsed when they're used, which also makes them the most recently used.
+        self.assertEqual(cache.get(id_1).id(), id_1)
+        cache.put(id_3, raw_3)
+        self.assertIn(id_1, cache)
+        self.assertNotIn(id_2, cache)
+        self.assertIsNone(cache.get(id_2))
+        self.assertEqual(cache.size, len(raw_1) + len(raw_3))
+
+    def test_fetch_from_store(self):
+        with open(self.cache_file, 'r') as f:
+            tx_id, raw_hex = next(iter(json.loads(f.read()).items()))
+        filename = os.path.join(tempfile.mkdtemp(), 'txs.dat')
+        cache, store = TxFetcher.cache, TxFetcher.store
+        try:
+            TxFetcher.cache = TxCache()
+            TxFetcher.open_store(filename)
+            TxFetcher.store.append(bytes.fromhex(tx_id), bytes.fromhex(raw_hex))
+            self.assertEqual(TxFetcher.fetch(tx_id).id(), tx_id)
+            self.assertIn(tx_id, TxFetcher.cache)
+            TxFetcher.store.close()
+        finally:
+            TxFetcher.cache, TxFetcher.store = cache, store
+
+    def test_prefetch(self):
+        with open(self.cache_file, 'r') as f:
+            disk_cache = json.loads(f.read())
+
+        # Answers from the test cache, and remembers what was asked.
+        class Session:
+            def __init__(self):
+                self.urls = []
+
+            def get(self, url):
+                self.urls.append(url)
+                response = lambda: None
+                response.text = disk_cache[url.split('/')[-1][:-len('.hex')]]
+                return response
+
+        raw_tx = bytes.fromhex('010000000456919960ac691763688d3d3bcea9ad6ecaf875df5339e148a1fc61c6ed7a069e010000006a47304402204585bcdef85e6b1c6af5c2669d4830ff86e42dd205c0e089bc2a821657e951c002201024a10366077f87d6bce1f7100ad8cfa8a064b39d4e8fe4ea13a7b71aa8180f012102f0da57e85eec2934a82a585ea337ce2f4998b50ae699dd79f5880e253dafafb7feffffffeb8f51f4038dc17e6313cf831d4f02281c2a468bde0fafd37f1bf882729e7fd3000000006a47304402207899531a52d59a6de200179928ca900254a36b8dff8bb75f5f5d71b1cdc26125022008b422690b8461cb52c3cc30330b23d574351872b7c361e9aae3649071c1a7160121035d5c93d9ac96881f19ba1f686f15f009ded7c62efe85a872e6a19b43c15a2937feffffff567bf40595119d1bb8a3037c356efd56170b64cbcc160fb028fa10704b45d775000000006a47304402204c7c7818424c7f7911da6cddc59655a70af1cb5eaf17c69dadbfc74ffa0b662f02207599e08bc8023693ad4e9527dc42c34210f7a7d1d1ddfc8492b654a11e7620a0012102158b46fbdff65d0172b7989aec8850aa0dae49abfb84c81ae6e5b251a58ace5cfeffffffd63a5e6c16e620f86f375925b21cabaf736c779f88fd04dcad51d26690f7f345010000006a47304402200633ea0d3314bea0d95b3cd8dadb2ef79ea8331ffe1e61f762c0f6daea0fabde022029f23b3e9c30f080446150b23852028751635dcee2be669c2a1686a4b5edf304012103ffd6f4a67e94aba353a00882e563ff2722eb4cff0ad6006e86ee20dfe7520d55feffffff0251430f00000000001976a914ab0c0b2e98b1ab6dbf67d4750b0a56244948a87988ac005a6202000000001976a9143c82d7df364eb6c75be8c80df2b3eda8db57397088ac46430600')
+        tx = Tx.parse(BytesIO(raw_tx))
+        cache, session = TxFetcher.cache, TxFetcher.session
+        try:
+            TxFetcher.cache = TxCache()
+            TxFetcher.session = Session()
+            self.assertEqual(tx.fee(), 140500)
+            # Each prev tx is downloaded once, and only once.
+            self.assertEqual(len(TxFetcher.session.urls), 4)
+            self.assertEqual(len(TxFetcher.cache), 4)
+            self.assertEqual(tx.fee(), 140500)
+            self.assertEqual(len(TxFetcher.session.urls), 4)
+        finally:
+            TxFetcher.cache, TxFetcher.session = cache, session
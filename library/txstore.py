@@ -0,0 +1,123 @@
+import mmap
+import os
+import struct
+import tempfile
+
+from unittest import TestCase
+
+# Each record of the file is the hash of a transaction (32 bytes, in the same order as Tx.hash()), the
+# length of its serialization (4 bytes little endian) and the serialization itself.
+RECORD_HEADER = struct.Struct('<32sI')
+
+
+# Append-only file of raw transactions by hash. The file is memory-mapped, and opening it only reads the
+# record headers to build the index, so no transaction is parsed until somebody asks for it.
+class TxStore:
+
+    def __init__(self, filename):
+        self.filename = filename
+        # Where the serialization of each transaction is in the file: hash -> (offset, length).
+        self.index = {}
+        self.map = None
+        self.end = self.scan()
+        self.file = open(filename, 'ab')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.index
+
+    # Maps the whole file in memory.
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        with open(self.filename, 'rb') as f:
+            # An empty file can't be mapped.
+            if os.fstat(f.fileno()).st_size > 0:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Builds the index from the records in the file, and returns where the last complete record ends.
+    def scan(self):
+        if not os.path.exists(self.filename):
+            return 0
+        self.remap()
+        size = len(self.map) if self.map is not None else 0
+        offset = 0
+        while offset + RECORD_HEADER.size <= size:
+            tx_hash, length = RECORD_HEADER.unpack_from(self.map, offset)
+            if offset + RECORD_HEADER.size + length > size:
+                break
+            self.index[tx_hash] = (offset + RECORD_HEADER.size, length)
+            offset += RECORD_HEADER.size + length
+        # A record that was only partially written (e.g. we were killed while appending it) is removed.
+        if offset < size:
+            self.map.close()
+            self.map = None
+            os.truncate(self.filename, offset)
+            self.remap()
+        return offset
+
+    # Returns the serialization of the transaction with the given hash, or None if it's not in the file.
+    def get(self, tx_hash):
+        entry = self.index.get(tx_hash)
+        if entry is None:
+            return None
+        offset, length = entry
+        # Records appended after the file was mapped need a new map.
+        if self.map is None or offset + length > len(self.map):
+            self.remap()
+        return self.map[offset:offset + length]
+
+    # Adds a transaction to the end of the file, unless it's already there.
+    def append(self, tx_hash, raw_tx):
+        if tx_hash in self.index:
+            return
+        self.file.write(RECORD_HEADER.pack(tx_hash, len(raw_tx)) + raw_tx)
+        self.file.flush()
+        self.index[tx_hash] = (self.end + RECORD_HEADER.size, len(raw_tx))
+        self.end += RECORD_HEADER.size + len(raw_tx)
+
+    def close(self):
+        self.file.close()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class TxStoreTest(TestCase):
+
+    def test_append_and_get(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'txs.dat')
+        store = TxStore(filename)
+        self.assertIsNone(store.get(b'\x01' * 32))
+        store.append(b'\x01' * 32, b'first')
+        store.append(b'\x02' * 32, b'second')
+        store.append(b'\x01' * 32, b'first')
+        self.assertEqual(store.get(b'\x01' * 32), b'first')
+        self.assertEqual(store.get(b'\x02' * 32), b'second')
+        store.close()
+        # Opening the file again only reads the headers.
+        store = TxStore(filename)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get(b'\x02' * 32), b'second')
+        store.append(b'\x03' * 32, b'third')
+        self.assertEqual(store.get(b'\x03' * 32), b'third')
+        store.close()
+
+    def test_partial_record(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'txs.dat')
+        store = TxStore(filename)
+        store.append(b'\x01' * 32, b'first')
+        store.close()
+        with open(filename, 'ab') as f:
+            f.write(RECORD_HEADER.pack(b'\x02' * 32, 100) + b'cut')
+        store = TxStore(filename)
+        self.assertEqual(len(store), 1)
+        store.append(b'\x03' * 32, b'third')
+        store.close()
+        store = TxStore(filename)
+        self.assertEqual(store.get(b'\x01' * 32), b'first')
+        self.assertEqual(store.get(b'\x03' * 32), b'third')
+        store.close()
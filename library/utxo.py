@@ -0,0 +1,291 @@
+import os
+import sqlite3
+import struct
+import tempfile
+
+from io import BytesIO
+from unittest import TestCase
+
+from .helper import encode_varint, read_varint
+from .script import Script, p2pkh_script
+from .tx import Tx, TxFetcher, TxIn, TxOut
+
+# The UTXO set is kept in a sqlite file. Keys are outpoints: the hash of the tx (in the same byte order as
+# TxIn.prev_tx) followed by the index of the output, 4 bytes little endian. Values are the amount, 8 bytes
+# little endian, followed by the raw ScriptPubKey (without its length).
+
+pack_index = struct.Struct('<I').pack
+pack_amount = struct.Struct('<Q').pack
+unpack_amount = struct.Struct('<Q').unpack_from
+
+# Number of blocks whose undo data is kept, which is how deep a reorg can be undone.
+UNDO_DEPTH = 100
+# ScriptPubKeys starting with OP_RETURN can't be spent, so they're never added.
+OP_RETURN = 0x6a
+
+
+def outpoint_key(prev_tx, prev_index):
+    return prev_tx + pack_index(prev_index)
+
+
+# Builds a TxOut from a value of the UTXO set.
+def value_to_tx_out(value):
+    raw_script = value[8:]
+    script_pubkey = Script.parse(BytesIO(encode_varint(len(raw_script)) + raw_script))
+    return TxOut(unpack_amount(value)[0], script_pubkey)
+
+
+# Undo data of a block: the hash of the block before it, the keys of the outputs it created and the
+# keys and values of the outputs it spent.
+def serialize_undo(prev_hash, created, spent):
+    result = prev_hash + encode_varint(len(created)) + b''.join(created)
+    result += encode_varint(len(spent))
+    for key, value in spent:
+        result += key + encode_varint(len(value)) + value
+    return result
+
+
+def parse_undo(data):
+    s = BytesIO(data)
+    prev_hash = s.read(32)
+    created = [s.read(36) for _ in range(read_varint(s))]
+    spent = []
+    for _ in range(read_varint(s)):
+        key = s.read(36)
+        spent.append((key, s.read(read_varint(s))))
+    return prev_hash, created, spent
+
+
+# The unspent outputs of the chain up to a block, built by connecting every block in order. Changes are
+# kept in memory and written in a single sqlite transaction every cache_size changes (or when flush is
+# called), so an output created and spent between two flushes never reaches the disk.
+class UtxoSet:
+
+    def __init__(self, filename=':memory:', cache_size=500000, testnet=False):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS utxos (outpoint BLOB PRIMARY KEY, output BLOB NOT NULL) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS undo (height INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        self.db.commit()
+        self.cache_size = cache_size
+        self.testnet = testnet
+        # Changes that are not on disk yet: the value of each added output, or None for spent ones.
+        self.cache = {}
+        # Keys of the outputs added since the last flush, which are not on disk.
+        self.fresh = set()
+        # Undo data of the blocks connected since the last flush, by height.
+        self.undo = {}
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        # Height and hash of the last connected block.
+        self.height = meta.get('height', 0)
+        self.tip = meta.get('hash')
+
+    def __repr__(self):
+        return 'utxo set height: {}'.format(self.height)
+
+    def get_value(self, key):
+        if key in self.cache:
+            return self.cache[key]
+        row = self.db.execute('SELECT output FROM utxos WHERE outpoint = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    # Returns the unspent output with the given outpoint as a TxOut, or None if it's not in the set.
+    def get(self, prev_tx, prev_index):
+        value = self.get_value(outpoint_key(prev_tx, prev_index))
+        if value is None:
+            return None
+        return value_to_tx_out(value)
+
+    def add_value(self, key, value):
+        self.cache[key] = value
+        self.fresh.add(key)
+
+    # Removes an output and returns its value.
+    def spend_value(self, key):
+        value = self.get_value(key)
+        if value is None:
+            raise ValueError('Output {}:{} is not in the UTXO set.'.format(key[:32].hex(), key[32:]))
+        if key in self.fresh:
+            # It never got to the disk, so there's nothing to delete.
+            del self.cache[key]
+            self.fresh.discard(key)
+        else:
+            self.cache[key] = None
+        return value
+
+    # Applies the block at the given height: created is a list of (tx hash, index, amount, raw script)
+    # with its outputs and spent a list of (prev tx hash, prev index) with the outpoints of its inputs
+    # (except the coinbase one).
+    def connect(self, height, block_hash, created, spent):
+        if height != self.height + 1:
+            raise ValueError('Block {} does not follow the UTXO set tip at height {}.'.format(height, self.height))
+        created_keys = []
+        for tx_hash, index, amount, raw_script in created:
+            if len(raw_script) > 0 and raw_script[0] == OP_RETURN:
+                continue
+            key = outpoint_key(tx_hash, index)
+            self.add_value(key, pack_amount(amount) + raw_script)
+            created_keys.append(key)
+        # Outputs are added first, so inputs can spend outputs of earlier txs of the same block.
+        spent_values = []
+        for prev_tx, prev_index in spent:
+            key = outpoint_key(prev_tx, prev_index)
+            spent_values.append((key, self.spend_value(key)))
+        self.undo[height] = serialize_undo(self.tip or b'\x00' * 32, created_keys, spent_values)
+        self.height = height
+        self.tip = block_hash
+        if len(self.cache) >= self.cache_size:
+            self.flush()
+
+    # Applies a parsed BlockMessage.
+    def connect_block(self, block, height):
+        created = []
+        spent = []
+        for txn in block.txns:
+            tx_hash = txn.hash()
+            for index, tx_out in enumerate(txn.tx_outputs):
+                # We take the script's bytes without its length, which doesn't need to parse it.
+                s = BytesIO(tx_out.serialize_script_pubkey())
+                raw_script = s.read(read_varint(s))
+                created.append((tx_hash, index, tx_out.amount, raw_script))
+            if not txn.is_coinbase():
+                spent.extend((tx_in.prev_tx, tx_in.prev_index) for tx_in in txn.tx_inputs)
+        self.connect(height, block.hash(), created, spent)
+
+    # Undoes the last connected block.
+    def disconnect(self):
+        data = self.undo.pop(self.height, None)
+        if data is None:
+            row = self.db.execute('SELECT data FROM undo WHERE height = ?', (self.height,)).fetchone()
+            if row is None:
+                raise ValueError('No undo data for block {}.'.format(self.height))
+            data = row[0]
+            # The undo data on disk is deleted with the next flush.
+            self.db.execute('DELETE FROM undo WHERE height = ?', (self.height,))
+        prev_hash, created, spent = parse_undo(data)
+        # Spent outputs are restored first, as some of them might have been created by this same block.
+        for key, value in spent:
+            # The output might still be on disk (if it was spent after the last flush), so it's not fresh.
+            self.cache[key] = value
+        for key in created:
+            self.spend_value(key)
+        self.height -= 1
+        self.tip = prev_hash if self.height > 0 else None
+
+    # Undoes blocks until the tip is at the given height.
+    def rewind(self, height):
+        while self.height > height:
+            self.disconnect()
+
+    # Writes every change to disk.
+    def flush(self):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO utxos (outpoint, output) VALUES (?, ?)',
+                                ((key, value) for key, value in self.cache.items() if value is not None))
+            self.db.executemany('DELETE FROM utxos WHERE outpoint = ?',
+                                ((key,) for key, value in self.cache.items() if value is None))
+            self.db.executemany('INSERT OR REPLACE INTO undo (height, data) VALUES (?, ?)', self.undo.items())
+            self.db.execute('DELETE FROM undo WHERE height <= ?', (self.height - UNDO_DEPTH,))
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('height', ?), ('hash', ?)",
+                            (self.height, self.tip))
+        self.cache = {}
+        self.fresh = set()
+        self.undo = {}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class UtxoSetTest(TestCase):
+
+    def make_tx(self, prev_outputs, amounts):
+        if len(prev_outputs) == 0:
+            # Like real coinbase txs, each one has a different ScriptSig so they don't have the same hash.
+            self.coinbases = getattr(self, 'coinbases', 0) + 1
+            tx_ins = [TxIn(b'\x00' * 32, 0xffffffff, Script([bytes([self.coinbases])]))]
+        else:
+            tx_ins = [TxIn(prev_tx, prev_index, Script([])) for prev_tx, prev_index in prev_outputs]
+        tx_outs = [TxOut(amount, p2pkh_script(bytes([i]) * 20)) for i, amount in enumerate(amounts)]
+        return Tx(1, tx_ins, tx_outs, 0)
+
+    def connect(self, utxos, txns):
+        created = []
+        spent = []
+        for txn in txns:
+            for index, tx_out in enumerate(txn.tx_outputs):
+                created.append((txn.hash(), index, tx_out.amount, tx_out.script_pubkey.raw_serialize()))
+            if not txn.is_coinbase():
+                spent.extend((tx_in.prev_tx, tx_in.prev_index) for tx_in in txn.tx_inputs)
+        utxos.connect(utxos.height + 1, bytes([utxos.height + 1]) * 32, created, spent)
+
+    def test_connect(self):
+        utxos = UtxoSet()
+        coinbase = self.make_tx([], [5000])
+        spend = self.make_tx([(coinbase.hash(), 0)], [3000, 1900])
+        self.connect(utxos, [coinbase, spend])
+        self.assertIsNone(utxos.get(coinbase.hash(), 0))
+        # The spent output never got to the disk.
+        self.assertNotIn(coinbase.hash() + pack_index(0), utxos.cache)
+        tx_out = utxos.get(spend.hash(), 1)
+        self.assertEqual(tx_out.amount, 1900)
+        self.assertEqual(tx_out.script_pubkey.serialize(), spend.tx_outputs[1].script_pubkey.serialize())
+        utxos.flush()
+        self.assertEqual(utxos.get(spend.hash(), 0).amount, 3000)
+        self.connect(utxos, [self.make_tx([], [5000]), self.make_tx([(spend.hash(), 0)], [2900])])
+        self.assertIsNone(utxos.get(spend.hash(), 0))
+        utxos.flush()
+        self.assertIsNone(utxos.get(spend.hash(), 0))
+        self.assertEqual(utxos.get(spend.hash(), 1).amount, 1900)
+        with self.assertRaises(ValueError):
+            self.connect(utxos, [self.make_tx([(spend.hash(), 0)], [2900])])
+
+    def test_rewind(self):
+        utxos = UtxoSet()
+        coinbase = self.make_tx([], [5000])
+        self.connect(utxos, [coinbase])
+        utxos.flush()
+        spend = self.make_tx([(coinbase.hash(), 0)], [4000])
+        self.connect(utxos, [self.make_tx([], [5000]), spend])
+        utxos.flush()
+        spend2 = self.make_tx([(spend.hash(), 0)], [3000])
+        self.connect(utxos, [self.make_tx([], [5000]), spend2])
+        # An output created and spent by the same block.
+        change = self.make_tx([(spend2.hash(), 0)], [3000])
+        self.connect(utxos, [self.make_tx([], [5000]), change, self.make_tx([(change.hash(), 0)], [2000])])
+        utxos.rewind(1)
+        self.assertEqual(utxos.height, 1)
+        self.assertEqual(utxos.tip, bytes([1]) * 32)
+        self.assertEqual(utxos.get(coinbase.hash(), 0).amount, 5000)
+        self.assertIsNone(utxos.get(spend.hash(), 0))
+        utxos.flush()
+        self.assertEqual(utxos.get(coinbase.hash(), 0).amount, 5000)
+        self.assertIsNone(utxos.get(spend.hash(), 0))
+
+    def test_persistence(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'utxos.sqlite')
+        utxos = UtxoSet(filename)
+        coinbase = self.make_tx([], [5000])
+        self.connect(utxos, [coinbase])
+        utxos.close()
+        utxos = UtxoSet(filename)
+        self.assertEqual(utxos.height, 1)
+        self.assertEqual(utxos.get(coinbase.hash(), 0).amount, 5000)
+        utxos.rewind(0)
+        self.assertIsNone(utxos.get(coinbase.hash(), 0))
+        utxos.close()
+
+    def test_fetcher(self):
+        utxos = UtxoSet()
+        coinbase = self.make_tx([], [5000])
+        self.connect(utxos, [coinbase])
+        spend = self.make_tx([(coinbase.hash(), 0)], [4000])
+        TxFetcher.utxo_set = utxos
+        try:
+            # The previous tx is not in TxFetcher's cache, so this would fail without the UTXO set.
+            self.assertEqual(spend.tx_inputs[0].value(), 5000)
+            self.assertEqual(spend.fee(), 1000)
+        finally:
+            TxFetcher.utxo_set = None
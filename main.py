@@ -1,90 +1,114 @@
-import os, sys
+import os, sys, time
 sys.path.append('/Users/jonathanerlich/Documents/git/block-explorer-test/explorer/explorer')
 sys.path.append('/Users/jonathanerlich/Documents/git/block-explorer-test/explorer/library')
 os.environ['DJANGO_SETTINGS_MODULE'] = 'explorer.settings'
 import django
 django.setup()
 
-from blocks.models import BlockRow, Transaction, TxInput, TxOutput 
-from library.network import SimpleNode, GetDataMessage, BLOCK_DATA_TYPE, TX_DATA_TYPE, BlockMessage, VersionMessage, MSG_WITNESS_BLOCK, GetHeadersMessage, HeadersMessage
-from library.block import Block
-from library.tx import Tx, TxIn, TxOut
-from library.helper import encode_varint, int_to_little_endian
-from helper_functions import get_type
+from library.chain import HeaderChain
+from library.download import PeerPool
+from library.tx import TxFetcher
+from library.utxo import UtxoSet
+from library.blockstore import BlockStore
+from blocks.ingest import BlockWriter, load_tip, reorganize
 
-# Connect to node
-node = SimpleNode('46.248.170.225')
-node.handshake()
-# Get all the blocks, starting from the genesis block.
-"""
-Get all block headers starting from the first one..
-"""
+# Nodes we download blocks from, as a comma separated list of IPs.
+PEERS = os.environ.get('PEERS', '46.248.170.225').split(',')
+# File where the validated block headers are kept between runs.
+HEADERS_FILE = os.environ.get('HEADERS_FILE', 'headers.dat')
+# File with the UTXO set of the saved blocks.
+UTXO_FILE = os.environ.get('UTXO_FILE', 'utxos.sqlite')
+# Directory where the raw blocks are kept, to reindex them without downloading them again.
+BLOCK_STORE_DIR = os.environ.get('BLOCK_STORE_DIR', 'blockstore')
+# Number of blocks downloaded in each round, before writing what's left in the writer.
+BODIES_BATCH = 2000
+
+
+# Rewinds the UTXO set to the given height, e.g. when it's ahead of the db. Returns False if it couldn't
+# be, as it only has the undo data of the last UNDO_DEPTH blocks (see library.utxo). The set must not be
+# updated anymore then.
+def rewind_utxos(utxos, height):
+    try:
+        utxos.rewind(height)
+    except ValueError as e:
+        print('could not rewind {} to height {}: {}'.format(utxos, height, e))
+        return False
+    utxos.flush()
+    return True
+
+
+# Connect to the nodes. Blocks are downloaded from all of them in parallel.
+pool = PeerPool.connect(PEERS)
+writer = BlockWriter()
+# Headers we already validated are loaded from disk.
+chain = HeaderChain(HEADERS_FILE)
+# The tip of our saved blocks is kept in memory, so blocks are validated without querying the db.
+tip = load_tip()
+utxos = UtxoSet(UTXO_FILE)
+# The UTXO set is saved right before each batch of blocks, so if we stopped in between it's ahead of the db.
+if utxos.height > tip.height:
+    rewind_utxos(utxos, tip.height)
+if utxos.height == tip.height:
+    writer.utxos = utxos
+    # Tx.fee() and Tx.verify() look up the outputs they need in our UTXO set first.
+    TxFetcher.utxo_set = utxos
+else:
+    # Blocks saved before we kept a UTXO set are not in it, and it might not have been rewound.
+    print('{} is not at the height of the db ({}), not updating it'.format(utxos, tip.height))
+# The same goes for the block store.
+block_store = BlockStore(BLOCK_STORE_DIR)
+if block_store.height > tip.height:
+    block_store.rewind(tip.height)
+if block_store.height == tip.height:
+    writer.block_store = block_store
+else:
+    print('{} is behind the db at height {}, not updating it'.format(block_store, tip.height))
 while True:
-    # If there are no objects in the db, we start asking for headers from the genesis block.
-    if len(BlockRow.objects.all()) == 0:
-        getheaders = GetHeadersMessage(start_block=bytes.fromhex('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f'))
-    # Else we start from the last added block.
-    else:
-        block_hash = BlockRow.objects.all().order_by("-pk_id")[0].hash_id
-        getheaders = GetHeadersMessage(start_block=bytes.fromhex(block_hash))
-    node.send(getheaders)
-    received_headers = node.wait_for(HeadersMessage)
-    print('received headers', received_headers)
-    # For each block header, ask for the block's information.
-    for block in received_headers.blocks:
-        # We check that the received block comes after the previous block in the blockchain.
-        if len(BlockRow.objects.all()) > 0:
-            if BlockRow.objects.all().order_by('-pk_id')[0].hash_id != block.prev_block.hex():
-                raise ValueError('Block is not the next one in the blockchain.')
-        if block.check_pow() is False:
-            raise ValueError('Bad PoW for current block.')
-        block = block.hash()
-        getdata = GetDataMessage()
-        getdata.add_data(MSG_WITNESS_BLOCK, block)
-        node.send(getdata)
-        received_block = node.wait_for(BlockMessage)
-        """ Save the blocks to the db """
-        # First I create a Block object to be able to get its id.
-        new_block = Block(received_block.version, received_block.prev_block, received_block.merkle_root, received_block.timestamp, received_block.bits, received_block.nonce)
-        # Then I create the row object to save in the db.
-        new_row = BlockRow(hash_id=new_block.hash().hex(), version=received_block.version, prev_block=received_block.prev_block.hex(), merkle_root=received_block.merkle_root.hex(), timestamp=received_block.timestamp, bits=received_block.bits[::-1].hex(), nonce=received_block.nonce[::-1].hex(), txn_count=received_block.txn_count)
-        new_row.save()
-        # Save each of the block's txs to the db.
-        for txn in received_block.txns:
-            new_tx_row = Transaction(block=new_row, hash_id=txn.id(), version=txn.version, locktime=txn.locktime, segwit=txn.segwit)
-            new_tx_row.save()
-            for tx_in in txn.tx_inputs:
-                # Check if the input has a witness.
-                if hasattr(tx_in, 'witness'):
-                    # This is a list, so we need to serialize it.
-                    witness_list = tx_in.witness
-                    # The following code serializes the witness.
-                    witness = b''
-                    for item in tx_in.witness:
-                        if type(item) == int:
-                            serialized_item = int_to_little_endian(item, 1)
-                            # We check that the item is not empty.
-                            if serialized_item != b'\x00':
-                                witness += serialized_item
-                        else:
-                            witness += encode_varint(len(item)) + item
-                    # We convert it to hex.
-                    witness = witness.hex()[2:]
-                # If input has no witness attribute, witness = None.
-                else:
-                    witness = None
-                new_tx_input_row = TxInput(transaction=new_tx_row, prev_tx=tx_in.prev_tx.hex(), prev_index=tx_in.prev_index, script_sig=tx_in.script_sig.serialize().hex()[2:], sequence=tx_in.sequence, witness=witness)
-                new_tx_input_row.save()
-            for tx_out in txn.tx_outputs:
-                # We need to establish the type of the output.
-                out_type = get_type(tx_out)
-                # If output is OP_RETURN, address doesn't apply.
-                # Also, we need to find the return data.
-                if out_type == 'OP_RETURN':
-                    address = None
-                    op_return_data = tx_out.script_pubkey.get_op_return_data()
-                else:
-                    address = tx_out.script_pubkey.address()
-                    op_return_data = None
-                new_tx_output_row = TxOutput(transaction=new_tx_row, output_type=out_type, amount=tx_out.amount, address=address, script_pubkey=tx_out.script_pubkey.serialize().hex()[2:], op_return_data=op_return_data)
-                new_tx_output_row.save()
\ No newline at end of file
+    """
+    Headers first: get and validate every block header starting from our last one.
+    """
+    # We ask the best connected node for the headers that come after our last header. Peers dropped
+    # during the last round are connected again first.
+    pool.reconnect()
+    peer = pool.alive_peers()[0]
+    try:
+        chain.sync(peer.node)
+    except OSError as e:
+        # The node went away while sending headers. It's dropped and we ask the next one, keeping the
+        # headers we already got.
+        print('dropping {}: {}'.format(peer, e))
+        peer.drop()
+        continue
+    # If our last saved block is not in the header chain anymore, there was a reorg and the blocks of
+    # the old branch are deleted.
+    if chain.height_of(tip.hash) is None:
+        tip = reorganize(chain, tip)
+        # The writer might remember outputs of the deleted blocks.
+        writer.outpoints.clear()
+        # A reorg deeper than the undo data of the UTXO set (e.g. when reorganize starts over from height 0)
+        # leaves it behind for good.
+        if writer.utxos is not None and not rewind_utxos(utxos, tip.height):
+            writer.utxos = None
+            TxFetcher.utxo_set = None
+            print('{} is not updated anymore'.format(utxos))
+        if writer.block_store is not None:
+            block_store.rewind(tip.height)
+    tip.height = chain.height_of(tip.hash)
+    height = tip.height
+    # If we have every block, we wait for new ones.
+    if height == chain.height():
+        time.sleep(60)
+        continue
+    """
+    Then the blocks: ranges of blocks are downloaded from every peer at once and handed to us in height order.
+    """
+    for start in range(height + 1, chain.height() + 1, BODIES_BATCH):
+        block_hashes = chain.hashes[start:start + BODIES_BATCH]
+        for received_block in pool.download(block_hashes):
+            # We check the block comes right after the previous one.
+            tip.connect(received_block.header())
+            """ Save the blocks to the db """
+            # Rows are buffered by the writer and written in bulk, one batch of blocks at a time.
+            writer.add(received_block, tip.height)
+        writer.flush()
+        print(tip, pool.alive_peers())